@@ -0,0 +1,639 @@
+from math import nan, sqrt, ceil, log, fsum
+from fractions import Fraction
+from hashlib import blake2b
+from random import Random
+from itertools import chain
+from heapq import heapify, heappush, heappop
+#Importing from da_* should be from da_* import *
+# so that get_daflat.py can ignore and the functions are in global scope
+from da_utils import *
+
+def to_number(x):
+    """
+    Return x as a float, or None if x is not a number.
+    Uses the same conversion rules as f_aggfunc, so that results match.
+    """
+    out = convert_float(x)
+    if out is nan:
+        return None
+    return out
+
+def add_partials(partials, x):
+    """
+    Add x to partials, the exact sum kept as floats which do not overlap (Shewchuk, like math.fsum).
+    fsum(partials) is the correctly rounded sum, so it does not depend on the order of the values,
+    and the partials of two states can be added together without any error.
+    """
+    i = 0
+    for y in partials:
+        if abs(x) < abs(y):
+            x, y = y, x
+        hi = x + y
+        lo = y - (hi - x)
+        if lo:
+            partials[i] = lo
+            i += 1
+        x = hi
+    partials[i:] = [x]
+
+def get_square(x):
+    """Return x*x as two floats (hi, lo) with hi+lo exactly x*x (Dekker)"""
+    hi = x*x
+    #Split x into halves of 26 bits, their products are exact
+    c = 134217729.0*x
+    x1 = c - (c - x)
+    x2 = x - x1
+    return hi, ((x1*x1 - hi) + 2*x1*x2) + x2*x2
+
+class Agg(object):
+    """
+    Running state of an aggregation function.
+
+    Values of a group are added one at a time using add(), the state is updated
+    in O(1) and result() returns the same output f_aggfunc would give on the
+    complete list of values.
+    """
+    #True if the function works on the numbers among the values
+    numeric = False
+    #True if the function needs all the values of the group (order-dependent functions)
+    needs_values = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def add(self, value, number):
+        """
+        value: the raw value
+        number: value as a float, None if it is not a number
+        """
+        pass
+
+    def result(self, values=None):
+        return None
+
+    def merge(self, other):
+        """Add the state of `other`, which saw the values that came after the values of this one"""
+        pass
+
+class AggFirst(Agg):
+    def __init__(self, name):
+        self.name = name
+        self.found = False
+        self.value = None
+
+    def add(self, value, number):
+        if not self.found:
+            self.value = value
+            self.found = True
+
+    def result(self, values=None):
+        return self.value
+
+    def merge(self, other):
+        if not self.found and other.found:
+            self.value = other.value
+            self.found = True
+
+class AggLast(Agg):
+    def __init__(self, name):
+        self.name = name
+        self.found = False
+        self.value = None
+
+    def add(self, value, number):
+        self.value = value
+        self.found = True
+
+    def result(self, values=None):
+        return self.value
+
+    def merge(self, other):
+        if other.found:
+            self.value = other.value
+            self.found = True
+
+class AggCount(Agg):
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+
+    def add(self, value, number):
+        self.count += 1
+
+    def result(self, values=None):
+        return self.count
+
+    def merge(self, other):
+        self.count += other.count
+
+class AggSum(Agg):
+    """Sum kept exact in partials, so that merged states give the same result as one state"""
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        self.n = 0
+        self.partials = []
+
+    def add(self, value, number):
+        if number != None:
+            self.n += 1
+            add_partials(self.partials, number)
+
+    def result(self, values=None):
+        if not self.n:
+            return None
+        return round(fsum(self.partials), 2)
+
+    def merge(self, other):
+        self.n += other.n
+        for x in other.partials:
+            add_partials(self.partials, x)
+
+class AggMean(AggSum):
+    def result(self, values=None):
+        if not self.n:
+            return None
+        return round(fsum(self.partials)/self.n, 2)
+
+class AggMax(Agg):
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+
+    def add(self, value, number):
+        if number != None and (self.value == None or number > self.value):
+            self.value = number
+
+    def result(self, values=None):
+        return self.value
+
+    def merge(self, other):
+        self.add(other.value, other.value)
+
+class AggMin(Agg):
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+
+    def add(self, value, number):
+        if number != None and (self.value == None or number < self.value):
+            self.value = number
+
+    def result(self, values=None):
+        return self.value
+
+    def merge(self, other):
+        self.add(other.value, other.value)
+
+class AggDiff(Agg):
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        self.min = None
+        self.max = None
+
+    def add(self, value, number):
+        if number == None:
+            return
+        if self.min == None or number < self.min:
+            self.min = number
+        if self.max == None or number > self.max:
+            self.max = number
+
+    def result(self, values=None):
+        if self.min == None:
+            return None
+        return round(self.max-self.min, 3)
+
+    def merge(self, other):
+        if other.min != None:
+            self.add(other.min, other.min)
+            self.add(other.max, other.max)
+
+class AggStddev(Agg):
+    """
+    Population standard deviation from the exact sums of the values and of their squares,
+    kept in partials. The variance is computed exactly (like statistics.pstdev), so merged
+    states give the same result as one state.
+    """
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        self.n = 0
+        self.partials = []
+        self.square_partials = []
+
+    def add(self, value, number):
+        if number == None:
+            return
+        self.n += 1
+        add_partials(self.partials, number)
+        for x in get_square(number):
+            add_partials(self.square_partials, x)
+
+    def result(self, values=None):
+        if not self.n:
+            return None
+        total = sum(map(Fraction, self.partials))
+        squares = sum(map(Fraction, self.square_partials))
+        return round(sqrt((squares - total*total/self.n)/self.n), 3)
+
+    def merge(self, other):
+        self.n += other.n
+        for x in other.partials:
+            add_partials(self.partials, x)
+        for x in other.square_partials:
+            add_partials(self.square_partials, x)
+
+class AggValues(Agg):
+    """
+    Order-dependent functions (median, pN, concat ...) need every value of the group,
+    the values are kept by AggState and passed in to result()
+    """
+    needs_values = True
+
+    def result(self, values=None):
+        return f_aggfunc(values, self.name, need_sort=True)
+
+class KLL(object):
+    """
+    KLL quantile sketch (Karnin, Lang, Liberty - Optimal Quantile Approximation in Streams).
+    Based on the reference implementation https://github.com/edoliberty/streaming-quantiles
+
+    Values are kept in a hierarchy of compactors, when a compactor is full it is sorted and
+    every other value is promoted to the next level (with twice the weight).
+    Memory is bounded by about 3*k values, for k=200 the rank of a quantile is within about
+    1.65% of the requested rank with 99% confidence. Until k values are seen the result is exact.
+    """
+    #Coin flips for the compactors, seeded so that results are repeatable
+    coin = Random(1)
+
+    def __init__(self, k=200, c=2/3):
+        self.k = k
+        self.c = c
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self.grow()
+
+    def grow(self):
+        self.compactors.append([])
+        self.max_size = sum([self.capacity(h) for h in range(len(self.compactors))])
+
+    def capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(ceil((self.c**depth)*self.k)) + 1
+
+    def update(self, x):
+        self.compactors[0].append(x)
+        self.size += 1
+        if self.size >= self.max_size:
+            self.compress()
+
+    def merge(self, other):
+        #Add the values of each level of other into the same level
+        while len(self.compactors) < len(other.compactors):
+            self.grow()
+        for h, c in enumerate(other.compactors):
+            self.compactors[h] += c
+        self.size = sum([len(c) for c in self.compactors])
+        while self.size >= self.max_size:
+            self.compress()
+
+    def compress(self):
+        for h in range(len(self.compactors)):
+            if len(self.compactors[h]) >= self.capacity(h):
+                if h+1 >= len(self.compactors):
+                    self.grow()
+                compactor = sorted(self.compactors[h])
+                #Keep the odd one out at this level
+                if len(compactor)%2:
+                    self.compactors[h] = [compactor.pop()]
+                else:
+                    self.compactors[h] = []
+                #Promote every other value, randomly choosing the odd or the even ones
+                offset = self.coin.randint(0, 1)
+                self.compactors[h+1] += compactor[offset::2]
+                self.size = sum([len(c) for c in self.compactors])
+                #Compact one level at a time
+                break
+
+    def is_exact(self):
+        """True if no values were compacted yet, every value seen is kept"""
+        return len(self.compactors) == 1
+
+    def quantile(self, q):
+        """Return the value at the rank q (0->1), same as data[int(q*len(data))] on the sorted data"""
+        items = sorted(chain.from_iterable([[(x, 2**h) for x in c] for h, c in enumerate(self.compactors)]))
+        if not items:
+            return None
+        total = sum([w for x, w in items])
+        rank = q*total
+        cumulative = 0
+        for x, w in items:
+            cumulative += w
+            if cumulative > rank:
+                return x
+        return items[-1][0]
+
+class AggQuantile(Agg):
+    """Approximate percentiles (apN) and median (amedian) using the KLL sketch"""
+    numeric = True
+    def __init__(self, name):
+        self.name = name
+        if name == 'amedian':
+            self.q = 0.5
+        else:
+            self.q = int(name[2:])/100
+        self.sketch = KLL()
+
+    def add(self, value, number):
+        if number != None:
+            self.sketch.update(number)
+
+    def result(self, values=None):
+        #While the sketch is exact, the median is the same as median/p50 (the mean of the
+        # two middle values for an even count)
+        if self.q == 0.5 and self.sketch.is_exact() and self.sketch.compactors[0]:
+            return stats.median(self.sketch.compactors[0])
+        return self.sketch.quantile(self.q)
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+class HyperLogLog(object):
+    """
+    HyperLogLog distinct count sketch (Flajolet et al.) with linear counting for small counts.
+
+    Uses 2**p registers, for p=12 it is 4KB for each sketch with a standard error of
+    1.04/sqrt(2**p), about 1.6%. Registers are kept in a dictionary until a few of them
+    are used, so that groups with few values stay small.
+    The hash is blake2b, so that sketches are the same across runs and machines.
+    """
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.alpha = 0.7213/(1 + 1.079/self.m)
+        #Sparse registers, register index -> rank
+        self.sparse = {}
+        #Dense registers, created once the sparse registers grow
+        self.registers = None
+
+    def add(self, value):
+        h = int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+        #First p bits choose the register, the position of the leftmost 1 in the rest is the rank
+        idx = h >> (64 - self.p)
+        w = h & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - w.bit_length() + 1
+        if self.registers != None:
+            if rank > self.registers[idx]:
+                self.registers[idx] = rank
+            return
+        if rank > self.sparse.get(idx, 0):
+            self.sparse[idx] = rank
+            #Switch to dense registers
+            if len(self.sparse) > self.m//128:
+                self.registers = bytearray(self.m)
+                for i, r in self.sparse.items():
+                    self.registers[i] = r
+                self.sparse = {}
+
+    def get_registers(self):
+        if self.registers != None:
+            return self.registers
+        registers = bytearray(self.m)
+        for i, r in self.sparse.items():
+            registers[i] = r
+        return registers
+
+    def merge(self, other):
+        """Union of the two sketches, the maximum of each register"""
+        if self.registers == None and other.registers == None:
+            for i, r in other.sparse.items():
+                if r > self.sparse.get(i, 0):
+                    self.sparse[i] = r
+            if len(self.sparse) <= self.m//128:
+                return
+        registers = self.get_registers()
+        for i, r in enumerate(other.get_registers()):
+            if r > registers[i]:
+                registers[i] = r
+        self.registers = registers
+        self.sparse = {}
+
+    def count(self):
+        registers = self.get_registers()
+        estimate = self.alpha*self.m*self.m/sum([2.0**-r for r in registers])
+        zeros = registers.count(0)
+        #Small range correction, linear counting
+        if estimate <= 2.5*self.m and zeros:
+            estimate = self.m*log(self.m/zeros)
+        return int(round(estimate))
+
+class AggNunique(Agg):
+    """Exact count of distinct values"""
+    def __init__(self, name):
+        self.name = name
+        self.values = set()
+
+    def add(self, value, number):
+        self.values.add(value)
+
+    def result(self, values=None):
+        return len(self.values)
+
+    def merge(self, other):
+        self.values |= other.values
+
+class AggApproxNunique(Agg):
+    """Approximate count of distinct values using the HyperLogLog sketch"""
+    def __init__(self, name):
+        self.name = name
+        self.sketch = HyperLogLog()
+
+    def add(self, value, number):
+        self.sketch.add(value)
+
+    def result(self, values=None):
+        return self.sketch.count()
+
+    def merge(self, other):
+        self.sketch.merge(other.sketch)
+
+class SpaceSaving(object):
+    """
+    Space-Saving heavy hitters (Metwally, Agrawal, El Abbadi - Efficient Computation of
+    Frequent and Top-k Elements in Data Streams), with weighted updates.
+
+    At most `capacity` items are counted. When a new item arrives and all the counters are used,
+    the item with the smallest count is replaced and the new item starts from that count.
+    The count of an item is an overestimate by at most its error, and the error is never
+    more than total/capacity. Weights have to be positive.
+
+    The smallest count is found with a min-heap of (count, seq, item), one entry for each item.
+    The entries are not updated when a count grows, an entry with an older (smaller) count
+    is pushed again with the current count when it comes to the top. So each update is
+    O(log capacity) amortized, instead of scanning all the counters for each new item.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        #item -> [count, error]
+        self.counters = {}
+        self.total = 0
+        self.heap = []
+        #Order of the heap entries with the same count, the older entry first
+        self.seq = 0
+
+    def push(self, item, count):
+        heappush(self.heap, (count, self.seq, item))
+        self.seq += 1
+
+    def pop_smallest(self):
+        """Remove the item with the smallest count, returns its count"""
+        while True:
+            count, seq, item = heappop(self.heap)
+            current = self.counters[item][0]
+            if current == count:
+                del self.counters[item]
+                return count
+            #The count has grown since the entry was pushed
+            self.push(item, current)
+
+    def add(self, item, weight=1):
+        self.total += weight
+        counter = self.counters.get(item)
+        if counter != None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+            self.push(item, weight)
+        else:
+            #Replace the item with the smallest count
+            min_count = self.pop_smallest()
+            self.counters[item] = [min_count+weight, min_count]
+            self.push(item, min_count+weight)
+
+    def merge(self, other):
+        """
+        Merge the counters of other (Agarwal et al. - Mergeable Summaries). An item missing from
+        a full counter could have been counted up to the smallest count of that counter.
+        """
+        def smallest(counter):
+            if len(counter.counters) < counter.capacity:
+                return 0
+            return min([c[0] for c in counter.counters.values()])
+        min1 = smallest(self)
+        min2 = smallest(other)
+        counters = {}
+        for item in set(self.counters) | set(other.counters):
+            c1 = self.counters.get(item, [min1, min1])
+            c2 = other.counters.get(item, [min2, min2])
+            counters[item] = [c1[0]+c2[0], c1[1]+c2[1]]
+        #Keep the largest counts
+        self.counters = dict(sorted(counters.items(), key=lambda x:-x[1][0])[:self.capacity])
+        self.total += other.total
+        self.heap = [(c[0], seq, item) for seq, (item, c) in enumerate(self.counters.items())]
+        heapify(self.heap)
+        self.seq = len(self.heap)
+
+    def top(self, n):
+        """Return the top n items as a list of (item, count, error)"""
+        items = sorted(self.counters.items(), key=lambda x:(-x[1][0], x[0]))[:n]
+        return [(item, count, error) for item, (count, error) in items]
+
+#Aggregation functions which can run in a single pass,
+# anything else falls back to AggValues
+agg_map = {'first': AggFirst,
+           'last': AggLast,
+           'count': AggCount,
+           'sum': AggSum,
+           'mean': AggMean,
+           'average': AggMean,
+           'avg': AggMean,
+           'max': AggMax,
+           'min': AggMin,
+           'diff': AggDiff,
+           'stddev': AggStddev,
+           'stdev': AggStddev,
+           'nunique': AggNunique,
+           'anunique': AggApproxNunique}
+
+def get_agg(aggfunc):
+    """Return the aggregator object for the aggregation function name"""
+    if aggfunc and (aggfunc == 'amedian' or (aggfunc.startswith('ap') and aggfunc[2:].isdigit())):
+        return AggQuantile(aggfunc)
+    return agg_map.get(aggfunc, AggValues)(aggfunc)
+
+class AggState(object):
+    """
+    Running aggregation state for the values of one group.
+
+    Holds one aggregator per aggregation function, the value is converted into
+    a number only once and shared by all the aggregators. The list of values is kept
+    only when one of the functions is order-dependent.
+    """
+    def __init__(self, aggfuncs):
+        self.aggs = [get_agg(f) for f in aggfuncs]
+        self.count = 0
+        #Only keep the values if they are needed
+        if any([a.needs_values for a in self.aggs]):
+            self.values = []
+        else:
+            self.values = None
+        #Only convert values into numbers if they are needed
+        self.numeric = any([a.numeric for a in self.aggs])
+
+    def add(self, value):
+        self.count += 1
+        if self.values != None:
+            self.values.append(value)
+        if self.numeric:
+            number = to_number(value)
+        else:
+            number = None
+        for a in self.aggs:
+            a.add(value, number)
+
+    def merge(self, other):
+        """Add the state of other, which has the values that came after the values of this state"""
+        self.count += other.count
+        if self.values != None:
+            self.values += other.values
+        for a, b in zip(self.aggs, other.aggs):
+            a.merge(b)
+
+    def result(self):
+        """Return the result of each aggregation function in order, None if there is no result"""
+        #If there is no value, there is no result
+        if not self.count:
+            return [None]*len(self.aggs)
+        return [a.result(self.values) for a in self.aggs]
+
+class KeyEncoder(object):
+    """
+    Dictionary encoding of keys. Each distinct key is kept once and gets an integer code,
+    codes are given in the order the keys are first seen (0, 1, 2 ...).
+    Hot loops look up the code once per row and keep their per-key data in lists indexed by
+    the code, instead of hashing the key again for every lookup.
+    """
+    def __init__(self):
+        #key -> code
+        self.codes = {}
+        #code -> key
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def encode(self, key):
+        """Return the code of key, adding it if it is new"""
+        code = self.codes.get(key)
+        if code == None:
+            code = self.codes[key] = len(self.keys)
+            self.keys.append(key)
+        return code
+
+    def decode(self, code):
+        return self.keys[code]
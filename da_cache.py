@@ -0,0 +1,240 @@
+import os
+import mmap
+import pickle
+from math import inf
+from array import array
+from itertools import repeat
+from collections import Counter
+#Importing from da_* should be from da_* import *
+# so that get_daflat.py can ignore and the functions are in global scope
+from da_utils import *
+from da_agg import *
+
+#First bytes of a cache file
+cache_header = b'da-cache 1\n'
+#Rows in each block of the cache file, a multiple of 8 so that the valid bitmaps of blocks can be joined
+cache_block_rows = 1<<16
+
+def get_cache_number(value):
+    """Return value as a float, None if it is not a number (inf and nan are not numbers, like in TypedColumn)"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number == inf or number != number:
+        return None
+    return number
+
+def get_zone_number(value):
+    """Return value as a float like the numeric filter conditions parse it (inf is a number), None if it is not a number or nan"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number:
+        return None
+    return number
+
+class CacheWriter(object):
+    """
+    Write rows into a columnar cache file, which can be read by Cache without splitting or
+    parsing the rows again.
+
+    The rows are written in blocks of cache_block_rows rows. For each column of a block:
+      codes: array('I') with the dictionary code of each cell
+      dictionary: pickled list of the distinct values of the cells, None is a cell missing in a shorter row
+      numbers: array('d') with the value of each cell, 0.0 if it is not a number
+      valid: bitmap of the cells which are numbers
+      missing: True if the column has cells missing in shorter rows
+      min, max, nulls: zone map of the block, the min and max of the numbers (None if there are
+        no numbers) and the count of the cells which are not numbers. Used to skip the blocks
+        which cannot match a filter or a range of values
+    numbers and valid are only written if the column has numbers in the block.
+    The offsets of the arrays are kept in a pickled footer at the end of the file,
+    followed by the offset of the footer (8 bytes).
+    """
+    def __init__(self, filename, heading=None, block_rows=cache_block_rows):
+        self.filename = filename
+        #Write to a temporary file, so that a failed run does not leave a partial cache behind
+        self.fd = open(filename + '.tmp', 'wb')
+        self.fd.write(cache_header)
+        self.heading = heading
+        self.block_rows = block_rows
+        self.rows = []
+        self.blocks = []
+        self.row_count = 0
+        self.columns = 0
+
+    def add_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) == self.block_rows:
+            self.write_block()
+
+    def write_array(self, data):
+        """Write the bytes of data and return its (offset, size)"""
+        offset = self.fd.tell()
+        data = bytes(data)
+        self.fd.write(data)
+        return (offset, len(data))
+
+    def write_column(self, n, size):
+        enc = KeyEncoder()
+        codes = array('I', [enc.encode(row[n] if n < len(row) else None) for row in self.rows])
+        column = {'codes': self.write_array(codes),
+                  'dictionary': self.write_array(pickle.dumps(enc.keys, protocol=pickle.HIGHEST_PROTOCOL)),
+                  'numbers': None, 'valid': None, 'valid_count': 0,
+                  #Cells missing in shorter rows
+                  'missing': None in enc.codes}
+        #Zone map, parsed once for each distinct value
+        zone = [get_zone_number(key) for key in enc.keys]
+        zone_numbers = [x for x in zone if x != None]
+        column['min'] = min(zone_numbers) if zone_numbers else None
+        column['max'] = max(zone_numbers) if zone_numbers else None
+        counts = Counter(codes)
+        column['nulls'] = sum(counts[code] for code, x in enumerate(zone) if x == None)
+        #Numbers are parsed once for each distinct value
+        numbers = [get_cache_number(key) for key in enc.keys]
+        if any(x != None for x in numbers):
+            valid = bytearray((size+7)//8)
+            for i, code in enumerate(codes):
+                if numbers[code] != None:
+                    valid[i >> 3] |= 1 << (i & 7)
+                    column['valid_count'] += 1
+            numbers = [0.0 if x == None else x for x in numbers]
+            column['numbers'] = self.write_array(array('d', [numbers[code] for code in codes]))
+            column['valid'] = self.write_array(valid)
+        return column
+
+    def write_block(self):
+        if not self.rows:
+            return
+        size = len(self.rows)
+        width = max(len(row) for row in self.rows)
+        self.columns = max(self.columns, width)
+        self.blocks.append({'rows': size,
+                            'columns': [self.write_column(n, size) for n in range(width)]})
+        self.row_count += size
+        self.rows = []
+
+    def close(self):
+        """Write the last block and the footer, and move the file in place"""
+        self.write_block()
+        footer = {'rows': self.row_count, 'columns': self.columns,
+                  'heading': self.heading, 'blocks': self.blocks}
+        offset = self.fd.tell()
+        pickle.dump(footer, self.fd, protocol=pickle.HIGHEST_PROTOCOL)
+        self.fd.write(offset.to_bytes(8, 'little'))
+        self.fd.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+def write_cache(T, filename):
+    """Write the rows of the Table T into the cache file filename, returns the number of rows written"""
+    writer = CacheWriter(filename, heading=list(T.heading) or None)
+    for row in T.data:
+        writer.add_row(row)
+    writer.close()
+    return writer.row_count, writer.columns
+
+class Cache(object):
+    """
+    Read a cache file written by CacheWriter. The file is memory mapped, and only the
+    blocks of the columns which are used are read.
+    Raises ValueError if the file is not a cache file.
+    """
+    def __init__(self, filename):
+        with open(filename, 'rb') as fd:
+            if fd.read(len(cache_header)) != cache_header:
+                raise ValueError("{} is not a da cache file".format(filename))
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = int.from_bytes(self.mm[-8:], 'little')
+        footer = pickle.loads(self.mm[offset:-8])
+        self.rows = footer['rows']
+        self.columns = footer['columns']
+        self.heading = footer['heading']
+        self.blocks = footer['blocks']
+
+    def get_array(self, ref, typecode):
+        """Return the array at ref (offset, size) as a memoryview on the file, without copying it"""
+        offset, size = ref
+        return memoryview(self.mm)[offset:offset+size].cast(typecode)
+
+    def get_dictionary(self, column):
+        offset, size = column['dictionary']
+        return pickle.loads(self.mm[offset:offset+size])
+
+    def get_heading(self, fields=None):
+        """Heading of the fields (all the columns if fields is None), [] if the cache has no heading"""
+        if not self.heading:
+            return []
+        if fields == None:
+            return list(self.heading)
+        return [self.heading[f] if f < len(self.heading) else 'col{}'.format(f) for f in fields]
+
+    def has_missing(self, n):
+        """Return True if column n has cells missing in shorter rows"""
+        return any(n >= len(block['columns']) or block['columns'][n]['missing'] for block in self.blocks)
+
+    def get_zone(self, block, n):
+        """
+        Return the zone map (min, max, nulls) of column n in the block, None if the cache has no zone maps.
+        A column missing in the block has no numbers.
+        """
+        if n >= len(block['columns']):
+            return (None, None, block['rows'])
+        column = block['columns'][n]
+        if 'min' not in column:
+            return None
+        return (column['min'], column['max'], column['nulls'])
+
+    def read_rows(self, fields=None, skip=None):
+        """
+        Yield the rows of the cache with the fields (all the columns if fields is None) as lists.
+        Only the columns of the fields are read, and the values are looked up from the codes,
+        nothing is split or parsed. Missing fields are None, so rows shorter than the widest
+        row are padded (with missing_char by Table.impute_missing).
+        Like the input with fields, rows without any of the fields are skipped.
+        skip: function of a block, True if none of its rows are needed (see get_zone), the
+          block is not read
+        """
+        if fields:
+            #A row has none of the fields if the lowest field is missing
+            first = fields.index(min(fields))
+            present = lambda row: row[first] != None
+        for block in self.blocks:
+            if skip != None and skip(block):
+                continue
+            columns = []
+            for n in (range(self.columns) if fields == None else fields):
+                if n < len(block['columns']):
+                    column = block['columns'][n]
+                    columns.append(map(self.get_dictionary(column).__getitem__,
+                                       self.get_array(column['codes'], 'I')))
+                else:
+                    columns.append(repeat(None, block['rows']))
+            rows = map(list, zip(*columns))
+            if fields and (min(fields) >= len(block['columns']) or block['columns'][min(fields)]['missing']):
+                rows = filter(present, rows)
+            yield from rows
+
+    def get_column_blocks(self, n, skip=None):
+        """
+        Yield (rows, numbers, valid, valid_count, codes, dictionary) of column n for each block,
+        numbers are the bytes of the array('d'), numbers and valid are None if the column has no numbers in the block, codes and dictionary
+        are None if the column is not in the block (all the cells are missing).
+        skip: function of the zone map (min, max, nulls) of the column, True if the block is not needed
+        """
+        for block in self.blocks:
+            if skip != None:
+                zone = self.get_zone(block, n)
+                if zone != None and skip(zone):
+                    continue
+            if n >= len(block['columns']):
+                yield block['rows'], None, None, 0, None, None
+                continue
+            column = block['columns'][n]
+            numbers = valid = None
+            if column['numbers'] != None:
+                numbers = self.get_array(column['numbers'], 'B')
+                valid = self.get_array(column['valid'], 'B')
+            yield (block['rows'], numbers, valid, column['valid_count'],
+                   self.get_array(column['codes'], 'I'), self.get_dictionary(column))
@@ -1,17 +1,35 @@
-import fileinput
 from math import nan, ceil, inf
-from itertools import tee, starmap, repeat, groupby
+from itertools import tee, starmap, repeat, groupby, islice, chain, compress
 from re import A, L
 import statistics as stats
 from collections import defaultdict, Counter
-from copy import deepcopy
+from copy import copy, deepcopy
 #Importing from da_* should be from da_* import *
 # so that get_daflat.py can ignore and the functions are in global scope
 from da_utils import *
 from da_custom import *
+from da_agg import *
+from da_filter import *
+from da_cache import *
 from operator import itemgetter
+from heapq import heappush, heappushpop, merge, nlargest, nsmallest
+import multiprocessing
+import pickle
+from array import array
+
+#First line of the state files written by Table.save_state
+state_header = b'da-state 1\n'
+#Options which define the aggregation state, states can only be merged if they are the same.
+# The other options (input files, decompression, output ..) can differ
+state_args = ('row_k', 'col_k', 'val_k', 'f', 'top_k', 'n', 'approx', 'counters', 'others')
 
 class Table(object):
+    #The input file name is added as field 0 only if asked (set in __init__)
+    file_column = False
+    #Cache file to read the rows from (set in __init__)
+    cache = None
+    #Function of a block of the cache, True if the block can be skipped (set by filterrows)
+    skip_block = None
     #Define the basic arguments needed for table
     # Use kwargs for the rest
     def __init__(self, src=None, delim=' ', heading=None, data=None,
@@ -38,6 +56,18 @@ class Table(object):
         self.max_fields = 0 
         #Character will be used to impute missing data
         self.missing_char = missing_char
+        #Number of processes to use for aggregating the input
+        self.jobs = args.get('jobs') or 1
+        #Read only the lines in this byte range of the source (used by the worker processes)
+        self.byte_range = args.get('byte_range')
+        #Decompress the input in another thread
+        self.decompress_thread = args.get('decompress_thread')
+        #Add the name of the input file as field 0
+        self.file_column = args.get('file_column') or False
+        #Read the rows from a cache file written by the ingest action instead of the input
+        self.cache = Cache(args['from_cache']) if args.get('from_cache') else None
+        #Partial aggregation states loaded from state files, to be merged
+        self.states = None
         #Check if fields are passed, we only need to filter data from those
         if isinstance(fields, str):
             self.fields = list(map(lambda x:int(x.strip()), fields.split(',')))
@@ -45,8 +75,11 @@ class Table(object):
             self.fields = []
         else:
             self.fields = fields
+        #If aggregation states are merged from state files
+        if args.get('state_files'):
+            self.load_states(args['state_files'])
         #If source is stdin or file
-        if data == None:
+        elif data == None:
             if src == None:
                 self.src = '-'
             else:
@@ -55,7 +88,6 @@ class Table(object):
         #Data is a list of lists; each row is a list; and in each row-list, the column items are in list
         else:
             self.build_table_from_data(data)
-        self.data, self.data_for_get_fields = tee(self.data, 2)
         self.get_fieldmap()
 
     def get_fieldmap(self): 
@@ -63,7 +95,7 @@ class Table(object):
         if self.fields == None or self.fields == []:
             self.field_map = dict(zip(range(self.max_fields), range(self.max_fields)))
         else:
-            self.field_map = dict(zip(self.fields, range(self.max_fields)))
+            self.field_map = dict(zip(self.fields, range(len(self.fields))))
 
     def add_row(self, row):
         self.data.append(row)
@@ -102,6 +134,14 @@ class Table(object):
         self.fields = self.fields or list(range(self.max_fields))
             
     def build_table_from_source(self):
+        #Only the fields are kept, so they are the width of the table
+        if self.fields:
+            self.max_fields = len(self.fields)
+        elif self.cache != None:
+            self.max_fields = self.cache.columns
+        #Use the heading of the cache
+        if self.cache != None and not self.heading:
+            self.heading = self.cache.get_heading(self.fields or None)
         #Read the source
         self.src_data = self.get_input()
         #Skip rows
@@ -110,6 +150,13 @@ class Table(object):
         #If the first line is heading, pop it out
         if self.h1:
             self.heading = next(self.src_data)
+            #Fields missing in the heading line are named by their field numbers
+            if self.fields:
+                self.heading = [h if h != None else 'col{}'.format(f) for h, f in zip(self.heading, self.fields)]
+            #The file name is not part of the heading line
+            fields = self.fields or [0]
+            if self.file_column and 0 in fields:
+                self.heading[fields.index(0)] = '__file__'
         #Impute missing data with missing_char
         if len(self.fields) > 0:
             len_check = len(self.fields)
@@ -121,28 +168,82 @@ class Table(object):
         return 'Table: delim="{}", heading={}, fields={}'.format(self.delim, self.heading, self.fields)
        
     def get_input(self):
-        """Read data from src, with delim to split fields"""
+        """
+        Read data from src, with delim to split fields.
+        src can be a list of files, they are read one after the other. Every file has the
+        rows to skip and the heading, they are used from the first file and skipped in the others.
+        The input is read as bytes, bytes which are not valid UTF-8 are replaced by U+FFFD
+        instead of stopping the run.
+        """
+        if self.cache != None:
+            #skip_block is looked up when the rows are first read, after filterrows has set it
+            yield from self.cache.read_rows(self.fields or None, skip=self.skip_block)
+            return
+        if self.byte_range:
+            yield from self.split_lines(read_range(self.src, *self.byte_range), self.src)
+            return
+        srcs = self.src if isinstance(self.src, list) else [self.src]
+        for n, src in enumerate(srcs):
+            rows = self.split_lines(read_lines(src, threaded=self.decompress_thread), src)
+            if n > 0:
+                rows = islice(rows, self.skip_rows + int(bool(self.h1)), None)
+            yield from rows
+
+    def split_lines(self, lines, src):
+        """Split the lines of src into fields, with the name of src as field 0 if file_column is set"""
+        prefix = [src] if self.file_column else []
+        #If fields param is passed, only split the line up to the last field needed
+        # and pick the fields with a getter built once
+        if self.fields:
+            yield from self.get_projected_input(lines, prefix)
+            return
         #For each line got from input
-        for line in fileinput.input(self.src):
-            #Strip the trailing newline character
-            line = line.strip('\n')
-            #Remove any leading spaces and split by the delim
-            info = line.strip().split(self.delim)
-            #If fields param is passed, Select only those fields
-            self.max_fields = max(len(info), self.max_fields)
-            if self.fields:
-                #Using dict and enumerate to access fields by numbers
-                filter_info = dict(enumerate(info))
-                #If field exists give the result, else return None
-                # This should also preserve the order of fields
-                info = list(filter(lambda x:x!=None, 
-                                   [filter_info.get(f, None) for f in self.fields]))
+        for line in lines:
+            #Remove any leading and trailing spaces and split by the delim
+            info = line.decode('utf-8', 'replace').strip().split(self.delim)
+            self.max_fields = max(len(info)+len(prefix), self.max_fields)
             #If an empty string
             if not info or info == ['']:
                 continue
+            if prefix:
+                info = prefix + info
             #Generate field list
             yield info
 
+    def get_projected_input(self, lines, prefix=[]):
+        """
+        Yield only self.fields of each line, in the order of self.fields.
+        The line is split at most max(fields)+1 times, the rest of the line is left unsplit.
+        Missing fields are None (imputed later with missing_char), lines without any of
+        the fields are skipped. prefix is added as the first fields of each line.
+        """
+        delim = self.delim
+        fields = self.fields
+        #Number of fields needed, and the splits needed to get them after the prefix
+        end = max(fields) + 1
+        maxsplit = max(end - len(prefix), 0)
+        first = min(fields)
+        if len(fields) == 1:
+            n = fields[0]
+            project = lambda info: [info[n]]
+        else:
+            get = itemgetter(*fields)
+            project = lambda info: list(get(info))
+        for line in lines:
+            info = line.decode('utf-8', 'replace').strip().split(delim, maxsplit)
+            if info == ['']:
+                continue
+            if prefix:
+                info = prefix + info
+            size = len(info)
+            #None of the fields exist
+            if size <= first:
+                continue
+            if size >= end:
+                yield project(info)
+            else:
+                yield [info[f] if f < size else None for f in fields]
+
     def impute_missing(self, lines, len_check):
         """Impute missing values on the dataset"""
         #Iterate over each line, find if the total fields in that line < len_check
@@ -156,24 +257,174 @@ class Table(object):
             line = [i.strip() if i else self.missing_char for i in line]
             yield line
 
+    def run_jobs(self, method):
+        """
+        Run the Table `method` on byte ranges of the input using `jobs` worker processes.
+        Each worker builds its own Table on a byte range and returns the partial result of `method`.
+        If the input is a list of files, each file is a job instead.
+
+        Returns the list of partial results in the order of the input, or None if jobs is 1
+        or the input cannot be split into byte ranges (pipes), so the caller runs it serially.
+        """
+        if self.jobs <= 1 or self.byte_range or self.cache != None:
+            return None
+        kwargs = dict(self.args)
+        kwargs.update({'src': self.src, 'delim': self.delim, 'fields': self.fields,
+                       'action': self.action, 'missing_char': self.missing_char, 'jobs': 1})
+        jobs = []
+        if isinstance(self.src, list):
+            #Every file has the rows to skip and the heading
+            for src in self.src:
+                jobs.append((dict(kwargs, src=src, skip_rows=self.skip_rows, h1=self.h1), method))
+        else:
+            #Byte ranges with whole lines
+            byte_ranges = get_line_ranges(self.src, self.jobs)
+            if not byte_ranges:
+                return None
+            for n, byte_range in enumerate(byte_ranges):
+                #Only the first range has the rows to skip and the heading
+                job_kwargs = dict(kwargs, byte_range=byte_range,
+                                  skip_rows=self.skip_rows if n == 0 else 0,
+                                  h1=self.h1 if n == 0 else False)
+                jobs.append((job_kwargs, method))
+        #fork, so that the workers can read stdin
+        with multiprocessing.get_context('fork').Pool(self.jobs) as pool:
+            results = pool.map(run_table_job, jobs, chunksize=1)
+        self.max_fields = max([self.max_fields] + [r[1] for r in results])
+        return [r[0] for r in results]
+
+    def run_file_jobs(self, method):
+        """
+        Yield the rows returned by the Table `method` (eg: get_filtered_rows) for each input file,
+        run by `jobs` worker processes, in the order of the files.
+        The workers are forked with this Table and run `method` on a copy of it for each file,
+        so that what is already set up (like the filter predicate) is not built again.
+        """
+        #fork, so that the workers get this Table without pickling it
+        with multiprocessing.get_context('fork').Pool(self.jobs, initializer=set_job_table,
+                                                      initargs=(self,)) as pool:
+            for rows, max_fields in pool.imap(run_file_job, [(src, method) for src in self.src]):
+                #max_fields is known once the rows of the file are read
+                self.max_fields = max(self.max_fields, max_fields)
+                yield from rows
+
+    def get_partials(self, method):
+        """
+        Partial results of `method` to merge, from the state files if they were loaded,
+        otherwise from worker processes (run_jobs). None if there is nothing to merge.
+        """
+        if self.states != None:
+            return self.states
+        return self.run_jobs(method)
+
+    def get_state_method(self):
+        """The method creating the aggregation state of the action"""
+        if self.action == 'pivot':
+            return 'get_pivot'
+        if self.action == 'topn' and self.args.get('approx'):
+            return 'get_topn_counters'
+        return 'get_groups'
+
+    def save_state(self, filename):
+        """
+        Write the aggregation state of the action (group, pivot, topn) instead of the result,
+        state files can be merged and printed using load_states (da merge).
+        State files are pickled, only load them from trusted sources.
+        """
+        #Set up the necessary variables for the action, GROUP/TOPN/PIVOT
+        getattr(self, self.action.upper())()
+        method = self.get_state_method()
+        state = getattr(self, method)()
+        self.fill_heading()
+        #emit_state/state_files/jobs are for this run only
+        args = {k: v for k, v in self.args.items() if k not in ('emit_state', 'state_files', 'jobs')}
+        with open(filename, 'wb') as fd:
+            fd.write(state_header)
+            pickle.dump({'action': self.action, 'method': method,
+                         'args': args, 'fields': self.fields, 'heading': self.heading,
+                         'max_fields': self.max_fields, 'state': state}, fd)
+
+    def load_states(self, filenames):
+        """
+        Load the state files written by save_state, they are merged when the action is run.
+        Raises ValueError if a file cannot be read, is not a state file or is truncated.
+        """
+        self.states = []
+        for filename in filenames:
+            try:
+                with open(filename, 'rb') as fd:
+                    is_state = fd.read(len(state_header)) == state_header
+                    if is_state:
+                        info = pickle.load(fd)
+            except OSError as e:
+                raise ValueError("Cannot read state file {}: {}".format(filename, e.strerror))
+            except (pickle.UnpicklingError, EOFError, ValueError) as e:
+                raise ValueError("{} is a truncated or corrupt da state file: {}".format(filename, e))
+            if not is_state:
+                raise ValueError("{} is not a da state file".format(filename))
+            if not self.states:
+                first = info
+            #Only states of the same aggregation can be merged
+            elif (info['method'], info['fields']) != (first['method'], first['fields']) or \
+                    any(info['args'].get(k) != first['args'].get(k) for k in state_args):
+                raise ValueError("{} was created with different options than {}".format(filename, filenames[0]))
+            self.states.append(info['state'])
+        self.action = first['action']
+        self.args = dict(first['args'], **{k: v for k, v in self.args.items() if k != 'state_files'})
+        self.fields = first['fields']
+        self.heading = first['heading']
+        self.max_fields = first['max_fields']
+        self.data = []
+
     def fill_heading(self):
         """Ensure heading for the expected columns have names, by choice or padding"""
         #If it is under or equal, pad it
         if len(self.heading)<=self.max_fields:
-            #Pad heading if there is not enough
-            self.heading += ['col{}'.format(i) for i in range(len(self.heading), self.max_fields)]
+            #Pad heading if there is not enough, named by the input field numbers
+            fields = self.fields or list(range(self.max_fields))
+            names = ['col{}'.format(fields[i]) if i < len(fields) else 'col{}'.format(i)
+                     for i in range(len(self.heading), self.max_fields)]
+            #Field 0 is the name of the input file
+            if self.file_column and 0 in fields and fields.index(0) >= len(self.heading):
+                names[fields.index(0)-len(self.heading)] = '__file__'
+            self.heading += names
         #if it's over, trim it
         else:
             self.heading=self.heading[:self.max_fields]
 
-    def get_fields(self, fieldN=None):
+    def get_fields(self, fieldN=None, rows=None, typed=False, value_range=None):
         """Return field name and data. Gets the input as columnar data.
         Dictionary 
         {field_number0: [heading_name, [row1, row2]],
          field_number1: ...}
+        rows: use these rows instead of the table data (see get_field_chunks)
+        typed: the data of each field is a TypedColumn instead of a list, so that the
+          numbers are parsed once while reading the rows
+        value_range: (min, max) of the numbers needed (None for no limit). The blocks of the
+          cache with numbers only outside the range are skipped, the caller still has to
+          drop the numbers outside the range
         """
+        if (typed and rows == None and self.cache != None and not self.skip_rows and not self.h1
+            and not (self.fields and self.cache.has_missing(min(self.fields)))):
+            #The cache has the numbers parsed already, the rows are not read
+            # (unless rows are skipped, rows without any of the fields are skipped too)
+            columns = [self.get_cache_column(n, value_range) for n in (self.fields or range(self.cache.columns))]
+            data = []
+        elif typed:
+            #Parse the cells of each position into a TypedColumn while reading, the rows are not kept
+            columns = []
+            for count, row in enumerate(self.data if rows == None else rows):
+                #Rows with more fields, the previous rows are missing these fields
+                for pos in range(len(columns), len(row)):
+                    columns.append(TypedColumn(repeat(self.missing_char, count)))
+                for pos, column in enumerate(columns):
+                    column.append(row[pos] if pos < len(row) else self.missing_char)
+            data = []
+        elif rows == None:
+            data = list(self.data)
+        else:
+            data = rows
         #To address bug where heading does not get populated
-        data = list(self.data)
         self.fill_heading()
         self.get_fieldmap()
         #If no fields is passed to get_fields
@@ -186,34 +437,146 @@ class Table(object):
                 fieldN = list(range(self.max_fields))
         #If fieldN is passed, make sure it is within limits
         else:
-            fieldN = list(filter(lambda x:x < self.max_fields, fieldN))
+            fieldN = list(filter(lambda x:x in self.field_map, fieldN))
         #self.fields is the field numbers of the input used to build the table
         #fieldN is the requested fields from (mapped to the input and not the table)
         #field_d = {field-number: [ heading, [data]], field-number: [h, [data]], ...}  
-        field_d = {n: [self.heading[self.field_map[n]], []] for n in fieldN}
+        if typed:
+            field_d = {}
+            for n in fieldN:
+                pos = self.field_map[n]
+                field_d[n] = [self.heading[pos], columns[pos] if pos < len(columns) else TypedColumn()]
+        else:
+            field_d = {n: [self.heading[self.field_map[n]], []] for n in fieldN}
         #populate data for field_d
         for row in data:
             for n in fieldN:
                 field_d[n][1].append(row[self.field_map[n]])
         return field_d
 
+    def get_cache_column(self, n, value_range=None):
+        """
+        Build the TypedColumn of field n from the cache, using the numbers parsed while ingesting.
+        The blocks with numbers only outside value_range (min, max) are skipped using the zone maps,
+        and C.skipped_numbers is set so that the column is still known to have numbers.
+        """
+        C = TypedColumn()
+        skip = None
+        if value_range != None:
+            minv, maxv = value_range
+            #Blocks without numbers are kept, their strings are needed if the column has no numbers
+            def skip(zone):
+                if zone[0] != None and ((minv != None and zone[1] < minv) or (maxv != None and zone[0] > maxv)):
+                    C.skipped_numbers = True
+                    return True
+                return False
+        for size, numbers, valid, valid_count, codes, dictionary in self.cache.get_column_blocks(n, skip=skip):
+            strings = None
+            if valid_count < size:
+                #The column is missing in the block
+                if dictionary == None:
+                    strings = repeat(C.dictionary.encode(self.missing_char), size)
+                #Codes of the block dictionary to the codes of the column, -1 for the numbers
+                else:
+                    keys = [-1 if get_cache_number(k) != None else C.dictionary.encode(self.missing_char if k == None else k)
+                            for k in dictionary]
+                    strings = map(keys.__getitem__, codes)
+            C.append_block(size, numbers, valid, valid_count, strings)
+        return C
+
+    def get_field_chunks(self, fieldN=None, size=None):
+        """
+        Yield the result of get_fields for chunks of `size` rows, so that the whole
+        data is not held in memory. If size is None, all the rows are one chunk.
+        At least one chunk is yielded, even if there are no rows.
+        """
+        if size == None:
+            yield self.get_fields(fieldN)
+            return
+        rows = iter(self.data)
+        chunk = list(islice(rows, size))
+        while True:
+            yield self.get_fields(fieldN, rows=chunk)
+            chunk = list(islice(rows, size))
+            if not chunk:
+                break
+
     def fast_ascii_table(self, heading_border=True, summary=False,
                          cell_width=15, repeat_heading=40):
         row_counter = 0
         row_f = ('{:<' + str(cell_width) + '} | ')*self.max_fields
         heading_f = row_f.format(*self.heading)
-        print(heading_f)
+        writer.write(heading_f)
         #If a heading border is needed
         #-1 is to accomodate for space after the last border
         heading_border = (len(heading_f)-1)*"-"
-        print(heading_border)
+        writer.write(heading_border)
         for i in self.data:
             row_counter += 1
             if row_counter%repeat_heading == 0:
-                print(heading_border)
-                print(heading_f)
-                print(heading_border)                        
-            print(row_f.format(*i), flush=True)
+                writer.write(heading_border)
+                writer.write(heading_f)
+                writer.write(heading_border)
+            writer.write(row_f.format(*i))
+
+    def progressive_ascii_table(self, sample=100, repeat_heading=40):
+        """
+        Print the ascii table while the rows are read, instead of reading all the rows to
+        find the cell widths. The widths are taken from the heading and the first `sample` rows.
+        When a later value does not fit, the column is widened and the heading is printed again
+        with the new widths (the same way the heading is repeated every repeat_heading rows).
+        """
+        rows = iter(self.data)
+        first_rows = list(islice(rows, sample))
+        #If heading was not yet populated, populate it now
+        if not self.heading:
+            self.fill_heading()
+        heading = list(map(str, self.heading))
+        widths = [len(h) for h in heading]
+
+        def fit(row):
+            """Widen the columns to fit row, returns True if the widths changed"""
+            changed = False
+            #Rows with more fields than the heading get colN headings
+            for n in range(len(heading), len(row)):
+                heading.append('col{}'.format(n))
+                widths.append(len(heading[n]))
+                changed = True
+            for n, v in enumerate(row):
+                if len(str(v)) > widths[n]:
+                    widths[n] = len(str(v))
+                    changed = True
+            return changed
+
+        def get_formats():
+            row_f = '{:<' + str(widths[0]) + '} | '
+            row_f += ''.join(['{:>' + str(w) + '} | ' for w in widths[1:]])
+            heading_f = row_f.format(*heading)
+            #-1 is to accomodate for space after the last border
+            heading_border = (len(heading_f)-1)*"-"
+            return row_f, heading_f, heading_border
+
+        for row in first_rows:
+            fit(row)
+        if not widths:
+            return None
+        row_f, heading_f, heading_border = get_formats()
+        writer.write(heading_f)
+        writer.write(heading_border)
+        row_counter = 0
+        for row in chain(first_rows, rows):
+            row_counter += 1
+            #Widen and print the heading again, or repeat the heading
+            if fit(row):
+                row_f, heading_f, heading_border = get_formats()
+                row_counter = 0
+            if row_counter%repeat_heading == 0:
+                writer.write(heading_border)
+                writer.write(heading_f)
+                writer.write(heading_border)
+            #Pad the rows with less fields
+            row = list(row) + [self.missing_char]*(len(heading)-len(row))
+            writer.write(row_f.format(*row))
 
     def to_ascii_table(self, heading_border=True, summary=0, repeat_heading=40):
         """Convert heading and data into a fancy table"""
@@ -234,7 +597,8 @@ class Table(object):
             self.fill_heading()
         if not rows:
             return None
-        result = ''
+        #Collect the lines and join them at the end, instead of growing a string
+        result = []
         all_lines = [self.heading] + rows
         rowf_d = {}
         for n in range(len(self.heading)):
@@ -247,68 +611,105 @@ class Table(object):
         row_f = '{:<' + rowf_d[0] + '} | '
         row_f += ''.join(['{:>' + rowf_d[v] +'} | ' for v in range(1, len(self.heading))])
         heading_f = row_f.format(*self.heading)
-        result += heading_f + '\n'
+        result.append(heading_f)
         #If a heading border is needed
         if heading_border:
             #-1 is to accomodate for space after the last border
             heading_border = (len(heading_f)-1)*"-"
-            result += heading_border + '\n'
+            result.append(heading_border)
         # Print until the penultimate row, the last few rows can be summary
         remaining_rows = 1+summary
         summary_rows = len(rows) - summary
         for i in rows[:summary_rows]:
             row_counter += 1
             if row_counter%repeat_heading == 0:
-                 result += heading_border + '\n'
-                 result += heading_f + '\n'
-                 result += heading_border + '\n'
-            result += row_f.format(*i)
-            result += '\n'
+                 result.append(heading_border)
+                 result.append(heading_f)
+                 result.append(heading_border)
+            result.append(row_f.format(*i))
         #If summary is needed, print a border
         if summary > 0:
             #-1 is to accomodate for space after the last border
             summary_border = (len(heading_f)-1)*"="
-            result += summary_border+'\n'
+            result.append(summary_border)
         #Now pring the summary_rows
         for i in rows[summary_rows:]:
-            result += row_f.format(*i)+'\n'
-        return result
+            result.append(row_f.format(*i))
+        return '\n'.join(result) + '\n'
 
     def pipe(self, delim=' ', disable_heading=False):
         """Pipe result to stdut, with fields separated by delim"""
         #Print the heading first
         if not disable_heading:
-            print(delim.join(self.heading))
+            writer.write(delim.join(self.heading))
         #Print the data next
-        for line in self.data:
-            print(delim.join(map(lambda x:str(x), line)), flush=True) 
+        writer.writelines(delim.join(map(str, line)) for line in self.data)
 
     def tocsv(self, disable_heading=False):
-        self.pipe(delim=',')
+        self.pipe(delim=',', disable_heading=disable_heading)
 
-    def rank(self, key=None, reverse=True, numeric=True, start_rank=0):
+    def rank(self, key=None, reverse=True, numeric=True, start_rank=0, method='competition'):
         """
         Ranks elements in the column. Reverse controls sorting order before the 
         element is ranked. reverse=True sorts data in descending order
 
-        Applies standard competition ranking method - https://en.wikipedia.org/wiki/Ranking
+        key: list
+          column field numbers to rank
+
+        reverse: Bool or list
+          Direction for all the keys, or a list with the direction of each key
+
+        method: str
+          Ranking method - https://en.wikipedia.org/wiki/Ranking
+          competition: standard competition ranking (1224), ties get the rank of the first one
+          dense: dense ranking (1223)
+          ordinal: ordinal ranking (1234), ties are ranked in the order of the data
+          percent: percent rank, (competition rank - 1)/(rows - 1), start_rank is not used
+
+        If the data is already sorted by the key (sort with the key as first sort key, in the same
+        direction), the ranks are assigned in a single pass without sorting again.
         """
         if key == None:
             key = [0]
+        if not isinstance(reverse, list):
+            reverse = [reverse]*len(key)
+        #If heading was not yet populated, populate it now
+        if not self.heading:
+            self.fill_heading()
         self.data = list(self.data)
-        for k in key:
-            rank = []
+        size = len(self.data)
+        for k, k_reverse in zip(key, reverse):
             if numeric:
-                unsorted_data = list(map(lambda x: convert_float(x[k]), self.data))
+                values = [get_number_key(x[k]) for x in self.data]
             else: 
-                unsorted_data = self.data
-            sorted_data = sorted(unsorted_data, reverse=reverse)
-            for i in unsorted_data:
-                rank.append(sorted_data.index(i)+start_rank)
+                values = [x[k] for x in self.data]
+            #Use the order from sort if the data is sorted by this key
+            if getattr(self, 'sorted_by', None) == (k, k_reverse, numeric):
+                order = range(size)
+            else:
+                order = sorted(range(size), key=values.__getitem__, reverse=k_reverse)
+            rank = [None]*size
+            dense = 0
+            for pos, i in enumerate(order):
+                #A new value, ties have the same value as the previous one
+                if pos == 0 or values[i] != values[order[pos-1]]:
+                    first = pos
+                    dense += 1
+                if method == 'dense':
+                    rank[i] = dense - 1 + start_rank
+                elif method == 'ordinal':
+                    rank[i] = pos + start_rank
+                elif method == 'percent':
+                    rank[i] = round(first/(size-1), 4) if size > 1 else 0.0
+                else:
+                    rank[i] = first + start_rank
             self.add_column(rank)
-            self.heading.append("rank({})".format(self.heading[k]))
+            if method == 'competition':
+                self.heading.append("rank({})".format(self.heading[k]))
+            else:
+                self.heading.append("{}_rank({})".format(method, self.heading[k]))
 
-    def sort(self, key=None, reverse=True, numeric=True):
+    def sort(self, key=None, reverse=True, numeric=True, memory_limit=None, limit=None):
         """
         Sort data by multiple keys.
 
@@ -322,106 +723,154 @@ class Table(object):
         numeric: Bool
           True: treat data in the column as floating point numbers
           False: treat data in the column as is
+
+        memory_limit: int
+          Bytes of rows to hold in memory. If the input is bigger, sorted runs are written to
+          temporary files and self.data is a k-way merge of the runs. None sorts in memory.
+
+        limit: int
+          Keep only the first limit rows of the sorted data. Uses a heap of limit rows
+          (nsmallest/nlargest) instead of sorting all the data, memory_limit is not needed.
         """
         if key == None:
             key = [0]
         if numeric:
-            self.data = sorted(self.data, key=lambda x : [convert_float(x[k]) for k in key], reverse=reverse)
+            sort_key = lambda x : [get_number_key(x[k]) for k in key]
+        else:
+            sort_key = itemgetter(*key)
+        if limit != None:
+            #Same as sorted(...)[:limit], ties keep the input order
+            if reverse:
+                self.data = nlargest(limit, self.data, key=sort_key)
+            else:
+                self.data = nsmallest(limit, self.data, key=sort_key)
+        elif memory_limit:
+            self.data = self.sort_external(sort_key, reverse, memory_limit)
         else:
-            self.data = sorted(self.data, key=itemgetter(*key), reverse=reverse)
+            self.data = sorted(self.data, key=sort_key, reverse=reverse)
+        #Keep the first sort key, so rank does not need to sort again
+        self.sorted_by = (key[0], reverse, numeric)
+
+    def sort_external(self, sort_key, reverse, memory_limit):
+        """
+        External merge sort. Rows are read till memory_limit bytes are used, each batch is 
+        sorted and written to a temporary file (a run), and the runs are merged with heapq.merge,
+        at most merge_fan_in at a time (see SortRuns).
+        Ties keep the input order like sorted(), as the runs are merged in the input order.
+
+        Returns a list if the input fits in memory_limit, else an iterator over the merged runs
+        """
+        runs = []
+        rows = []
+        size = 0
+        key_size = None
+        sort_runs = None
+        for row in self.data:
+            #The sort keys of all the rows have the same shape
+            if key_size == None:
+                key_size = get_key_size(sort_key(row))
+            rows.append(row)
+            size += get_row_size(row) + key_size
+            if size >= memory_limit:
+                #The chunks of the runs being merged use about as much memory as one batch
+                if sort_runs == None:
+                    sort_runs = SortRuns(chunk_size=max(1, min(1000, len(rows)//merge_fan_in)))
+                rows.sort(key=sort_key, reverse=reverse)
+                runs.append(sort_runs.write_run(rows))
+                rows = []
+                size = 0
+        rows.sort(key=sort_key, reverse=reverse)
+        if not runs:
+            return rows
+        return sort_runs.merge_runs(runs, key=sort_key, reverse=reverse, last=rows)
     
-    def filterfunc(self, pattern):
+    def filterfunc(self, pattern, bloom=None):
         """
         format:
-         F1 AND F2 AND F3 ...
+         F1 AND F2 OR NOT F3 ...
          where F1 is 
           fN operator operand
+         Conditions can be combined with AND, OR, NOT and grouped with parentheses.
+         NOT binds tighter than AND, which binds tighter than OR. Evaluation stops
+         as soon as the result is known.
         
         Operand1: Has to be of the format fN, where N is a number and indicates field number. (zero-indexed)
         Operand2: If wrapped under quotes (double/single), interpreted as string and only string operators are applied.
           If not wrapped under quoted, interpreted as floating point numbers and numerical operations are applied
         Numerical operators:
          ==, !=, >=, <=, >, <
+         Rows where the field is not a number do not match
         String operators:
-         == - include rows with string op2 (case sensitive)
-         != - exclude rows with string op2 (case sensitive)
-        """
-        function_l = []
-        #Split the filter checks by "AND"
-        for i in pattern.split('AND'):
-            i = i.strip()
-            action = [a.strip() for a in i.split()]
-            op1 = int(action[0][1:])
-            opr = action[1]
-            op2 = action[2]
-            #Check if the second operand is string or number
-            # Use quotes around the operand to check this
-            if op2[0] in ("'", '"') and op2[-1] in ("'", '"'):
-                op2_type = 'string'
-            else:
-                op2_type = 'float'
-            #numerical oerations
-            if op2_type == 'float':
-                if opr in ('>', '<', '==', '!=', '<=', '>='):
-                    function_l.append('float(data[{}]) {} {}'.format(op1, opr, op2))
-            #String operations
-            elif op2_type == 'string':
-                if opr == '===':
-                    opr_use = '=='                    
-                    function_l.append('data[{}] {} {}'.format(op1, opr_use, op2))
-                elif opr == '!==':
-                    opr_use = '!='                    
-                    function_l.append('data[{}] {} {}'.format(op1, opr_use, op2))
-                elif opr in ('=='):
-                    opr_use = '=='
-                    function_l.append('data[{}].casefold() {} {}.casefold()'.format(op1, opr_use, op2))
-                elif opr in ('!='):
-                    opr_use = '!='
-                    function_l.append('data[{}].casefold() {} {}.casefold()'.format(op1, opr_use, op2))
-        return function_l
+         == - include rows with string op2 (case insensitive)
+         != - exclude rows with string op2 (case insensitive)
+         === - include rows with string op2 (case sensitive)
+         !== - exclude rows with string op2 (case sensitive)
+         ~ - include rows matching the regex op2 (python re.search)
+         !~ - exclude rows matching the regex op2
+         contains - include rows containing the string op2 (case sensitive)
+         startswith - include rows starting with the string op2 (case sensitive)
+        Set operator:
+         fN in @file - include rows where fN is one of the lines in file. The lines are loaded
+          into a set, or into a Bloom filter with false positive rate bloom if it is passed
+
+        Returns a function, which returns True for the rows matching the pattern
+        """
+        return compile_filter(pattern, bloom=bloom)
 
     def filtermap(self, data):
-        conditions_true = 0
-        #Cycle through each check
-        for i in self.function_l:
-            #Check if it evaluates to False
-            if not eval(i):
-                #If it is False, skip checking other checks (chained AND is implemented)
-                conditions_true = False
-                continue
-            else:
-                #check returns True, mark it as true, move to next check
-                conditions_true = True
-        #If tagging is needed the rows needs to be retained
-        # and additional column needs to be added
-        #Else return only the row which passes all checks
-        if self.tag == True:
-            #If conditions_true remained True, 
-            if conditions_true and conditions_true !=0:
-                return data + [self.pass_tag]
-            else:
-                return data + [self.fail_tag]
+        #Tag the row with the result of the checks
+        if self.predicate(data):
+            return data + [self.pass_tag]
         else:
-            # And if tagging is not needed, return the row 
-            # and If conditions_true remained True, then only return the row
-            if conditions_true and conditions_true !=0:
-                return data
-            # else return None
-            else:
-                return None
+            return data + [self.fail_tag]
 
-    def filterrows(self, pattern, tag=False):
+    def filterrows(self, pattern, tag=False, bloom=None):
         self.tag = tag
         self.pass_tag = 'Yes'
         self.fail_tag = 'No'
         self.tag_heading = 'tagged'
-        self.function_l = self.filterfunc(pattern)
-        filter_results = list(filter(lambda x:x!=None, map(self.filtermap, self.data)))
-        self.data = filter_results
+        self.predicate = self.filterfunc(pattern, bloom=bloom)
+        #Skip the blocks of the cache which cannot match, all the rows are needed with tag
+        if self.cache != None and not self.tag and not self.skip_rows and not self.h1:
+            self.skip_block = self.get_block_skip(pattern)
+        #Filter the input files in worker processes
+        if self.jobs > 1 and isinstance(self.src, list):
+            self.data = self.run_file_jobs('get_filtered_rows')
+        else:
+            self.data = self.get_filtered_rows()
         #if tagging is enabled, add the heading 'tagged'
         if self.tag == True:
             self.heading += [self.tag_heading]
 
+    def get_block_skip(self, pattern):
+        """
+        Return a function of a block of the cache, True if no row of the block can match the
+        filter pattern, checked with the zone maps (min/max) of the fields in the block
+        """
+        may_match = compile_zone_filter(pattern)
+        cache = self.cache
+        fields = self.fields or range(cache.columns)
+        def skip(block):
+            #Fields after the last field are missing in every row
+            zones = lambda n: cache.get_zone(block, fields[n]) if n < len(fields) else (None, None, block['rows'])
+            return not may_match(zones)
+        return skip
+
+    def get_filtered_rows(self):
+        #Filter lazily, so that the rows are read only as they are printed (used by limit_rows)
+        #If tagging is needed the rows needs to be retained
+        # and additional column needs to be added
+        if self.tag == True:
+            return map(self.filtermap, self.data)
+        return filter(self.predicate, self.data)
+
+    def limit_rows(self, n):
+        """
+        Keep only the first n rows. The data is not read after the first n rows,
+        so this stops reading the input once n rows are printed.
+        """
+        self.data = islice(self.data, n)
+
     def transpose(self):
         """
         Convert rows to columns
@@ -438,7 +887,8 @@ class Table(object):
         if row_k == None:
             self.row_k = [1]
         else:
-            self.row_k = row_k
+            #Copy, as TOPN adds to it
+            self.row_k = list(row_k)
         #If val_k is passed we will need to use that column
         if val_k != None:
             self.val_k = val_k
@@ -448,9 +898,9 @@ class Table(object):
         self.aggfunc = self.args['f']
 
     def TOPN(self):
-        self.action = 'topn'
         #Run GROUPING actions first
         self.GROUP()
+        self.action = 'topn'
         self.top_k = self.args['top_k']
         self.n = self.args['n']
         self.row_k.append(*self.top_k)
@@ -484,26 +934,7 @@ class Table(object):
         """Pivot on row index and column index with an aggregation function applied on value index"""
         #To set up the necessary variables
         self.PIVOT()
-        #row pointer as the result will be got from the table in the order r, c, v
-        # The order comes from da_tool when handling fields needed for table creation    
-        rp = 0 
-        cp = 1
-        vp = 2
-        row_v = set()
-        col_v = set()
-        #Pivot_d
-        # 'Row1' : { 'Col1': [value_list], 'Col2': [value_list] },
-        # 'Row2' : { 'Col1': [value_list], 'Col2': ... }
-        pivot_d = defaultdict(dict)
-        for d in self.data:
-            #Get the row index, if it's None, use nan
-            row_v.add(d[rp] or nan)
-            #Get the column index, if it's None, use nan
-            col_v.add(d[cp] or nan)
-            #Get the values in a list for each rowindex, colindex, if it's None use 0
-            if not pivot_d[d[rp]].get(d[cp]):
-                pivot_d[d[rp]][d[cp]] = []
-            pivot_d[d[rp]][d[cp]].append(d[vp] or 0)
+        pivot_d, row_v, col_v = self.get_pivot()
         #Making col_v into a list and sort it
         col_v = sorted(list(col_v))
         row_v = sorted(list(row_v))
@@ -512,8 +943,11 @@ class Table(object):
         for row in row_v:
             col_r = []
             for col in col_v:
-                data = sorted(pivot_d[row].get(col, []))
-                cell = f_aggfunc(data, self.aggfunc) or self.missing_char
+                state = pivot_d[row].get(col)
+                if state == None:
+                    cell = self.missing_char
+                else:
+                    cell = state.result()[0] or self.missing_char
                 col_r.append(cell)
             #If row share needs to be computed
             if self.row_share == True:
@@ -534,7 +968,7 @@ class Table(object):
         # where X, Y, Z are the field numbers from the input file
         # and the order is by rp, cp, vp
         self.fill_heading() #to fix the heading bug
-        self.heading = ['{}({}/{})'.format(self.aggfunc, self.heading[rp], self.heading[cp])]
+        self.heading = ['{}({}/{})'.format(self.aggfunc, self.heading[0], self.heading[1])]
         self.heading += self.col_v
         self.pivotheading = self.heading
         #Reset max_fields
@@ -545,6 +979,64 @@ class Table(object):
                              rowsummary=self.rowsummary, colsummary=self.colsummary)
             self.data[-1] += ['*']*len(self.summaryfunc)
 
+    def get_pivot(self):
+        """create_pivot, using multiple processes if jobs is more than 1, or merging the state files"""
+        partials = self.get_partials('get_pivot')
+        if partials == None:
+            return self.create_pivot()
+        #Merge the partial results in the order of the input
+        pivot_d, row_v, col_v = partials[0]
+        for p_pivot_d, p_row_v, p_col_v in partials[1:]:
+            row_v |= p_row_v
+            col_v |= p_col_v
+            for row, cols in p_pivot_d.items():
+                for col, state in cols.items():
+                    if pivot_d[row].get(col) == None:
+                        pivot_d[row][col] = state
+                    else:
+                        pivot_d[row][col].merge(state)
+        return pivot_d, row_v, col_v
+
+    def create_pivot(self):
+        """Create the aggregation state of each row index x column index"""
+        #row pointer as the result will be got from the table in the order r, c, v
+        # The order comes from da_tool when handling fields needed for table creation    
+        rp = 0 
+        cp = 1
+        vp = 2
+        #Row and column index values are dictionary encoded, each row looks up
+        # two codes and the state, states[row code] = {col code: AggState}
+        row_enc = KeyEncoder()
+        col_enc = KeyEncoder()
+        row_codes = row_enc.codes
+        col_codes = col_enc.codes
+        states = []
+        for d in self.data:
+            r_code = row_codes.get(d[rp])
+            if r_code == None:
+                r_code = row_enc.encode(d[rp])
+                states.append({})
+            c_code = col_codes.get(d[cp])
+            if c_code == None:
+                c_code = col_enc.encode(d[cp])
+            #Update the aggregation state for each rowindex, colindex with the value, if it's None use 0
+            state = states[r_code].get(c_code)
+            if state == None:
+                state = states[r_code][c_code] = AggState([self.aggfunc])
+            state.add(d[vp] or 0)
+        #Decode into
+        #Pivot_d
+        # 'Row1' : { 'Col1': AggState, 'Col2': AggState },
+        # 'Row2' : { 'Col1': AggState, 'Col2': ... }
+        pivot_d = defaultdict(dict)
+        for row, cols in zip(row_enc.keys, states):
+            for c_code, state in cols.items():
+                pivot_d[row][col_enc.decode(c_code)] = state
+        #Get the row/column index, if it's None, use nan
+        row_v = set([row or nan for row in row_enc.keys])
+        col_v = set([col or nan for col in col_enc.keys])
+        return pivot_d, row_v, col_v
+
     def add_summary(self, summary_data, summary_heading, func,
                     rowsummary=True,
                     colsummary=True):
@@ -590,24 +1082,112 @@ class Table(object):
     def get_topn(self):
         #To set up the necessary variables
         self.TOPN()
-        group_d, group_k = self.create_groups()
-        group_data = self.process_groups(group_d, group_k)
+        if self.args.get('approx'):
+            return self.get_topn_approx()
+        others = self.args.get('others')
+        group_d, group_k = self.get_groups()
+        #Keep a heap of size n for each row-index as the grouped rows are produced
+        # heap_d = {row-index: [(value, -sequence, grouped row), ...]}
+        heap_d = {}
+        #others_d = {row-index: [count of items not in topn, sum of their values]}
+        others_d = {}
+        for seq, row in enumerate(self.process_groups(group_d, group_k)):
+            heap = heap_d.get(row[0])
+            if heap == None:
+                heap = heap_d[row[0]] = []
+                others_d[row[0]] = [0, 0]
+            #-sequence makes the earlier row win the ties, same as a stable sort
+            item = (row[-1], -seq, row)
+            if len(heap) < self.n:
+                heappush(heap, item)
+            else:
+                item = heappushpop(heap, item)
+                if others:
+                    others_d[row[0]][0] += 1
+                    others_d[row[0]][1] += to_number(item[0]) or 0
         topn_d = {}
-        for row, data in groupby(group_data, key=lambda x:x[0]):
-            topn = sorted(data, key=lambda x:x[-1], reverse=True)[:self.n]
+        for row, heap in heap_d.items():
+            topn = [x[2] for x in sorted(heap, reverse=True)]
             topn_d[row] = list(map(lambda x:'{}({})'.format(x[1], x[2]), topn))
             topn_items = len(topn_d[row]) 
             if topn_items < self.n:
                 for i in range(topn_items, self.n):
                     topn_d[row].append('-')
+            #Items that are not in the topn, count(sum of values)
+            if others:
+                topn_d[row].append('{}({})'.format(others_d[row][0], round(others_d[row][1], 2)))
         data = self.flatten_d(topn_d)
         self.data = data
+        self.heading = self.create_topn_heading()
+        if others:
+            self.heading.append('others')
+
+    def get_topn_approx(self):
+        """
+        Top n using a Space-Saving counter for each row-index, memory is bounded by
+        the number of row-index x counters. Only count and sum can be used.
+        """
+        topn_d = self.get_topn_counters()
+        data = []
+        for row in sorted(topn_d):
+            topn = topn_d[row].top(self.n)
+            cells = ['{}({})'.format(item, round(count, 2)) for item, count, error in topn]
+            cells += ['-']*(self.n-len(topn))
+            #Counts are overestimated by at most the error of the item
+            max_error = max([error for item, count, error in topn] or [0])
+            data.append([row, *cells, round(max_error, 2)])
+        self.data = data
+        self.heading = self.create_topn_heading() + ['max_error']
+
+    def get_topn_counters(self):
+        """create_topn_counters, using multiple processes if jobs is more than 1, or merging the state files"""
+        partials = self.get_partials('get_topn_counters')
+        if partials == None:
+            return self.create_topn_counters()
+        #Merge the partial results in the order of the input
+        topn_d = partials[0]
+        for p_topn_d in partials[1:]:
+            for row, counter in p_topn_d.items():
+                if topn_d.get(row) == None:
+                    topn_d[row] = counter
+                else:
+                    topn_d[row].merge(counter)
+        return topn_d
+
+    def create_topn_counters(self):
+        """Count the -t items of each row-index with a SpaceSaving counter"""
+        capacity = max(self.args.get('counters') or self.n*10, self.n)
+        sum_values = self.aggfunc[0] == 'sum'
+        #Row-index values are dictionary encoded, counters[code] is the counter of the row-index
+        row_enc = KeyEncoder()
+        row_codes = row_enc.codes
+        counters = []
+        for d in self.data:
+            code = row_codes.get(d[0])
+            if code == None:
+                code = row_enc.encode(d[0])
+                counters.append(SpaceSaving(capacity))
+            counter = counters[code]
+            if sum_values:
+                weight = to_number(d[2])
+                #Only positive weights can be counted
+                if weight == None or weight < 0:
+                    continue
+            else:
+                weight = 1
+            counter.add(d[1], weight)
+        return dict(zip(row_enc.keys, counters))
+
+    def create_topn_heading(self):
         #Fix the heading bug, to populate it
         self.fill_heading()
-        self.heading = ['({},{})->{}'.format(self.heading[self.field_map.get(self.row_k[0])], 
-                                          self.heading[self.field_map.get(self.row_k[1])], 
-                                          self.heading[self.field_map.get(self.val_k[0])])]
-        self.heading += ['top{}'.format(i) for i in range(1, self.n+1)]
+        #field_map is built before the input is read, refresh it
+        self.get_fieldmap()
+        heading = ['({},{})->{}'.format(self.heading[self.field_map.get(self.row_k[0])], 
+                                        self.heading[self.field_map.get(self.row_k[1])], 
+                                        self.heading[self.field_map.get(self.val_k[0])])]
+        heading += ['top{}'.format(i) for i in range(1, self.n+1)]
+        return heading
 
     def flatten_d(self, d):
         flat_l = []
@@ -615,49 +1195,83 @@ class Table(object):
             flat_l.append([k, *d[k]])
         return flat_l 
 
-    def create_groups(self):
-        """Group is for grouping and summarising data for row ind key using data from valueind"""
+    def get_groups(self):
+        """create_groups, using multiple processes if jobs is more than 1, or merging the state files"""
         #row pointer as the result will be got from the table in the order r, c, v
         # The order comes from da_tool when handling fields needed for table creation    
         self.rp = len(self.row_k)
         self.vp = list(range(self.rp, len(self.fields)))
+        partials = self.get_partials('get_groups')
+        if partials == None:
+            return self.create_groups()
+        #Merge the partial results in the order of the input
+        group_d, group_k = partials[0]
+        for p_group_d, p_group_k in partials[1:]:
+            group_k |= p_group_k
+            for v in self.vp:
+                for r_key, state in p_group_d[v].items():
+                    if group_d[v].get(r_key) == None:
+                        group_d[v][r_key] = state
+                    else:
+                        group_d[v][r_key].merge(state)
+        return group_d, group_k
+
+    def create_groups(self):
+        """Group is for grouping and summarising data for row ind key using data from valueind"""
+        rp = self.rp
+        vp = self.vp
+        #The row-index keys are dictionary encoded, the key of each row is looked up once
+        # states[code] = [AggState of each value field] for the row-index with the code
+        # A single field row-index is encoded as is, without building a tuple
+        key_enc = KeyEncoder()
+        key_codes = key_enc.codes
+        states = []
+        for d in self.data:
+            r_key = d[0] if rp == 1 else tuple(d[:rp])
+            code = key_codes.get(r_key)
+            if code == None:
+                code = key_enc.encode(r_key)
+                states.append([AggState(self.aggfunc) for v in vp])
+            #Update the aggregation state of each rowindex with the value, if it's None use nan
+            for v, state in zip(vp, states[code]):
+                state.add(d[v] or nan)
         #group_d will create a dictionary, with key as the row-index
-        # and values is the list of values for that row-index
-        group_d = defaultdict(dict)
-        for v in self.vp:
-            group_d[v] = defaultdict(list)
+        # and values is the running aggregation state (AggState) of the values for that row-index
+        group_d = {}
+        for v in vp:
+            group_d[v] = {}
         #group_k will hold the keys of the row-index
         group_k = set()
-        for d in self.data:
+        for r_key, r_states in zip(key_enc.keys, states):
+            if rp == 1:
+                r_key = (r_key,)
             #Get the row index, if it's None, use nan
-            group_k.add(tuple(d[:self.rp]) or nan)
-            #Get the values in a list for each rowindex, if it's None use nan
-            for v in self.vp:
-                r_key = tuple(d[:self.rp])
-                group_d[v][r_key].append(d[v] or nan)
+            group_k.add(r_key or nan)
+            for v, state in zip(vp, r_states):
+                group_d[v][r_key] = state
         return group_d, group_k
 
     def process_groups(self, group_d, group_k):
         """
-        group_d: has the data for each group
+        group_d: has the aggregation state for each group
         group_k: Keys or the grouped items from which group_d can be accessed
+
+        Yields the grouped rows, sorted by the group keys
         """
         #Process the groups and print the grouped results
         #Making group_k into a list and sort it
         group_k = sorted(list(group_k))
-        group_data = []
         for row in group_k:
             row_data = []
             for v in self.vp:
-                cells = []
-                for f in self.aggfunc:
-                    cell = f_aggfunc(group_d[v][row], f, need_sort=True)
-                    if cell == None:
-                        cell = self.missing_char
-                    cells.append(cell)
-                row_data += cells
-            group_data.append(list(row) + row_data)
-        return group_data
+                state = group_d[v].get(row)
+                if state == None:
+                    cells = [None]*len(self.aggfunc)
+                else:
+                    cells = state.result()
+                #If there is no result, use missing_char
+                row_data += [self.missing_char if cell == None else cell for cell in cells]
+            yield list(row) + row_data
 
     def create_group_heading(self):
         #Set the heading of the first column of the new table
@@ -677,7 +1291,7 @@ class Table(object):
     def group(self):
         #To set up the necessary variables
         self.GROUP()
-        group_d, group_k = self.create_groups()
+        group_d, group_k = self.get_groups()
         self.data = self.process_groups(group_d, group_k)
         self.heading = self.create_group_heading() 
 
@@ -692,6 +1306,33 @@ class Table(object):
         return self.to_ascii_table(heading_border=True,
                                    summary=summary_rows) 
 
+def run_table_job(job):
+    """Worker for Table.run_jobs, build the Table and run the method"""
+    kwargs, method = job
+    T = Table(**kwargs)
+    #Set up the necessary variables for the action, GROUP/TOPN/PIVOT
+    getattr(T, T.action.upper())()
+    return getattr(T, method)(), T.max_fields
+
+#The Table copied by the workers of Table.run_file_jobs, set when the worker starts
+job_table = None
+
+def set_job_table(T):
+    global job_table
+    job_table = T
+
+def run_file_job(job):
+    """
+    Worker for Table.run_file_jobs, run the method on a copy of the Table reading src.
+    Returns the rows and the max_fields of the file (needed for the heading)
+    """
+    src, method = job
+    T = copy(job_table)
+    T.src = src
+    T.build_table_from_source()
+    rows = list(getattr(T, method)())
+    return rows, T.max_fields
+
 class ColumnTable(Table):
     """
     A object with multiple columns as its members
@@ -734,18 +1375,139 @@ class ColumnTable(Table):
     def __repr__(self):
         return 'ColumnTable: heading={}, name={}'.format(self.heading, self.name)
 
+class TypedColumn(object):
+    """
+    Column data parsed once into a typed store
+    numbers: array('d') with the value of each cell, 0.0 if the cell is not a number
+    valid: bitmap (bit i is set if cell i is a number)
+    codes: array('l') with the dictionary code of the cells which are not numbers, -1 for numbers.
+      It is created only when the first cell which is not a number is added, so numeric
+      columns do not have it
+    dictionary: KeyEncoder with each distinct string kept once
+    skipped_numbers: True if blocks of a cache with numbers were skipped (see Table.get_cache_column)
+
+    A float in array('d') takes 8 bytes, instead of ~32 bytes for a float object
+    and its list slot, and the numbers are not parsed again by each user.
+    Iterating the column gives the numbers, and nan for the cells which are not numbers.
+    """
+    def __init__(self, values=None):
+        self.numbers = array('d')
+        self.valid = bytearray()
+        self.codes = None
+        self.dictionary = KeyEncoder()
+        self.size = 0
+        self.valid_count = 0
+        self.skipped_numbers = False
+        if values != None:
+            for value in values:
+                self.append(value)
+
+    def append(self, value):
+        n = self.size
+        if n & 7 == 0:
+            self.valid.append(0)
+        try:
+            number = float(value)
+            #inf (e.g. 12e123131) and nan are not treated as numbers
+            if number == inf or number != number:
+                raise ValueError
+            self.numbers.append(number)
+            self.valid[n >> 3] |= 1 << (n & 7)
+            self.valid_count += 1
+            if self.codes != None:
+                self.codes.append(-1)
+        except (TypeError, ValueError):
+            self.numbers.append(0.0)
+            if self.codes == None:
+                self.codes = array('l', repeat(-1, n))
+            self.codes.append(self.dictionary.encode(value))
+        self.size += 1
+
+    def append_block(self, size, numbers=None, valid=None, valid_count=0, codes=None):
+        """
+        Append a block of size cells which are already parsed (used to read the cache files).
+        numbers and valid are the bytes of the numbers and the bitmap of the cells which are numbers
+        (None if there are none), codes are the dictionary codes of the cells, -1 for the numbers.
+        The column size has to be a multiple of 8, so that the bitmaps can be joined.
+        """
+        if numbers != None:
+            self.numbers.frombytes(numbers)
+            self.valid += valid
+        else:
+            self.numbers.frombytes(bytes(8*size))
+            self.valid += bytes((size+7)//8)
+        if valid_count < size:
+            if self.codes == None:
+                self.codes = array('l', repeat(-1, self.size))
+            self.codes.extend(codes)
+        elif self.codes != None:
+            self.codes.extend(repeat(-1, size))
+        self.valid_count += valid_count
+        self.size += size
+
+    def is_valid(self, i):
+        return (self.valid[i >> 3] >> (i & 7)) & 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if self.is_valid(i):
+            return self.numbers[i]
+        return nan
+
+    def __iter__(self):
+        if self.valid_count == self.size:
+            return iter(self.numbers)
+        return map(self.__getitem__, range(self.size))
+
+    def valid_numbers(self):
+        """Return an array of the numbers, skipping the cells which are not numbers"""
+        if self.valid_count == self.size:
+            return self.numbers
+        return array('d', compress(self.numbers, map(self.is_valid, range(self.size))))
+
+    def get_strings(self):
+        """Return the cells as strings, numbers are converted back using str()"""
+        keys = self.dictionary.keys
+        if self.valid_count == 0:
+            return [keys[c] for c in self.codes or []]
+        codes = self.codes or repeat(-1)
+        return [keys[c] if c != -1 else str(x) for c, x in zip(codes, self.numbers)]
+
+    def count_strings(self):
+        """
+        Return a Counter of the cells as strings, in the order they are first seen.
+        The codes are counted, so each string is hashed once instead of once per cell.
+        """
+        if self.valid_count != 0:
+            return Counter(self.get_strings())
+        keys = self.dictionary.keys
+        return Counter({keys[c]: n for c, n in Counter(self.codes or []).items()})
+
 class Column(object):
     def __init__(self, data=None, name='Col', dtype=float, categorical=False):
         """
         Initialise the data necessary to create a column object
 
-        data: list input of column data
+        data: list input of column data, or a TypedColumn (used as is, the data is
+          not copied or converted again)
         """
         #Set up the column with data from name
         self.name = name
-        #Since Table usually passes generators, Convert into list since we will be reusing the data
-        self.data = list(data)
-        if categorical:
+        #Typed store of the column, if the data was parsed at ingest
+        self.store = None
+        if isinstance(data, TypedColumn):
+            self.categorical = False
+            self.store = data
+            self.data = data
+        else:
+            #Since Table usually passes generators, Convert into list since we will be reusing the data
+            self.data = list(data)
+        if self.store != None:
+            #The data is already parsed into numbers
+            pass
+        elif categorical:
             self.categorical=True
         else:
             self.categorical=False
@@ -820,8 +1582,14 @@ class Column(object):
         return starmap(lambda a,b:f(a,b) if (a and b)!=None else nan, zip(self.data,
                                                                           self.get_operand(other)))
 
+    def get_categorical(self):
+        """Return the column data as strings"""
+        if self.store != None:
+            return self.store.get_strings()
+        return self.data_as_categorical
+
     def f_concat(self, other):
-        return starmap(lambda a,b:str(a)+'_'+str(b), zip(self.data_as_categorical, other.data_as_categorical))
+        return starmap(lambda a,b:str(a)+'_'+str(b), zip(self.get_categorical(), other.get_categorical()))
 
     def astype(self, x, f):
         try:
@@ -906,7 +1674,10 @@ class Column(object):
     def summary(self):
         result = []
         #Filter out nans for handling continous data
-        data_no_nans = sorted(self.filter_nans(self.data))
+        if self.store != None:
+            data_no_nans = sorted(self.store.valid_numbers())
+        else:
+            data_no_nans = sorted(self.filter_nans(self.data))
         size = len(data_no_nans)
         dtype = None
         if size > 0:
@@ -928,8 +1699,12 @@ class Column(object):
             result.append(['max', max(data_no_nans)])
         else:
             dtype = 'categorical'
-            size = len(self.data_as_categorical)
-            Ctr = Counter(self.data_as_categorical)
+            if self.store != None:
+                size = len(self.store)
+                Ctr = self.store.count_strings()
+            else:
+                size = len(self.data_as_categorical)
+                Ctr = Counter(self.data_as_categorical)
             result.append(['unique', len(Ctr.keys())])
             result.append(['count', size])
             cumsum = 0
@@ -949,3 +1724,72 @@ class Column(object):
         return dtype, result
 
 
+
+def is_rowwise_transform(t):
+    """Check if the parsed transform t (and its chain) only has element-wise functions"""
+    return all(f['func'] in rowwise_transforms for f in [t] + (t['chain'] or []))
+
+def transform_fields(pTable, t_list):
+    """
+    Apply the parsed transforms in t_list on the fields of pTable (result of Table.get_fields)
+    Returns a ColumnTable with the fields followed by the transformed columns.
+    t_list is not modified, so that it can be used on the next chunk of the fields.
+    """
+    tTable = ColumnTable(data=[], heading=[], name='Transformed')
+    for pk, pv in pTable.items():
+        pCol = Column(pv[1], name=pv[0], categorical=True)
+        tTable.add(pCol)
+    #Each item in t_list is the parsed transform string of --function input
+    # which defines the actions to follow 
+    for t in t_list:
+        #If param is a number, use it, if it's a field, get the Column object of that field
+        if t['is_field']:
+            params = Column(pTable[t['params']][1], name=pTable[t['params']][0])
+        else:
+            params = t['params']
+        # Hack to check if it is a categorical column
+        #Check if 'params' can be converted into float
+        categorical = False
+        if not t['is_field']:            
+            try:
+                #If it can be, then its likely a numerical column
+                params = float(t['params'])
+            except ValueError:
+                #Else its intended to be a categorical column
+                params = t['params']
+                categorical = True
+        #Get the data for the fields where transform needs to be applied
+        # and create a column object, name it using alias key
+        if isinstance(params, (Column)):
+            param_name = params.name
+        else:
+            param_name = t['params']
+        #If column name is not defined, create one of the format func(a,b)
+        # a is field/col name
+        # b can be param of field/col name
+        alias = t['alias']
+        if alias == '':
+            alias = '{}({},{})'.format(t['func'],
+                                       pTable[t['fields'][0]][0],
+                                       param_name)
+        #Create the column
+        #pTable(fieldN) -> gets the data
+        # fieldN is the field on which we start the transformation
+        tCol = Column(pTable[t['fields'][0]][1],
+                      name=alias,
+                      categorical=categorical)
+        #Apply transform to the column
+        tCol.apply_transform(t['func'],
+                             params)
+        #If there is a chain function, follow the same process as above one-after-another
+        if t['chain']:
+            for c in t['chain']:
+                #If param is a number, use it, if it's a field, get the Column object of that field
+                if c['is_field']:
+                    c_params = Column(pTable[c['params']][1])
+                else:
+                    c_params = c['params']
+                tCol.apply_transform(c['func'], c_params)
+        #Add the transformed columns into the table
+        tTable.add(tCol)
+    return tTable
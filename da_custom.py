@@ -264,3 +264,9 @@ def f_tag(data, other=None):
         tag_d[info.get(0)] = info.get(1, '-')
     return [tag_d.get(i, '-') for i in data]
 
+
+#Transforms which work on each value of the column independently (the result of a row
+# does not depend on the other rows), these can be run on chunks of the rows
+rowwise_transforms = ['add', 'divide', 'div', 'floordiv', 'subtract', 'sub', 'multiply', 'mul',
+                      'gt', 'lt', 'ge', 'le', 'eq', 'mod', 'dummy', 'subtract_from', 'concat',
+                      'f_round', 'f_formatunixtime', 'f_tag', 'f_dummyfunctionfortransform']
@@ -0,0 +1,397 @@
+import re
+import operator
+from math import log, ceil
+from hashlib import blake2b
+#Importing from da_* should be from da_* import *
+# so that get_daflat.py can ignore and the functions are in global scope
+from da_utils import *
+
+#Operators for numeric operands
+numeric_ops = {'>': operator.gt, '<': operator.lt, '>=': operator.ge,
+               '<=': operator.le, '==': operator.eq, '!=': operator.ne}
+#Checks of the numeric operators on the (min, max) of a block, True if any number in the range can match
+zone_ops = {'>': lambda lo, hi, value: hi > value, '<': lambda lo, hi, value: lo < value,
+            '>=': lambda lo, hi, value: hi >= value, '<=': lambda lo, hi, value: lo <= value,
+            '==': lambda lo, hi, value: lo <= value <= hi}
+#Operators for string (quoted) operands
+string_ops = ('==', '!=', '===', '!==', '~', '!~', 'contains', 'startswith')
+#Tokens of the pattern, quoted strings, parentheses, operators and words (fN, numbers, AND/OR/NOT, contains..)
+filter_token_re = re.compile(r"""\s*(?:('[^']*'|"[^"]*")|([()])|(===|!==|==|!=|>=|<=|>|<|!~|~)|([^\s()'"<>=!~]+))""")
+#Characters with a special meaning in regular expressions
+regex_special = '.^$*+?{}[]()|\\'
+
+#Length of the escapes \xhh, \uhhhh and \Uhhhhhhhh
+hex_escape_size = {'x': 4, 'u': 6, 'U': 10}
+octal_digits = '01234567'
+
+def get_escape_size(regex, i):
+    """Return the length of the escape starting with the backslash at regex[i]"""
+    escaped = regex[i+1:i+2]
+    if escaped in hex_escape_size:
+        return hex_escape_size[escaped]
+    if escaped == 'N' and regex[i+2:i+3] == '{':
+        end = regex.find('}', i)
+        return len(regex) - i if end == -1 else end + 1 - i
+    if escaped == '0':
+        #Octal escape, \0 and up to 2 more octal digits
+        size = 2
+        while size < 4 and regex[i+size:i+size+1] and regex[i+size] in octal_digits:
+            size += 1
+        return size
+    if escaped.isdigit():
+        #Octal escape of 3 digits, or a group reference of 1 or 2 digits
+        digits = regex[i+1:i+4]
+        if len(digits) == 3 and all(d in octal_digits for d in digits):
+            return 4
+        return 3 if regex[i+2:i+3].isdigit() else 2
+    return 2
+
+def get_regex_literal(regex):
+    """
+    Return the longest literal string that every match of the regex contains, '' if there is none.
+    Used to reject rows with a substring check before running the regex. Only the literals
+    outside groups and character classes are used, and regexes with alternation or
+    inline flags (like case insensitive) get no literal.
+    """
+    if '|' in regex or '(?' in regex:
+        return ''
+    runs = []
+    run = ''
+    depth = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            escaped = regex[i+1:i+2]
+            #Escaped punctuation is a literal, letters and digits are classes (\d, \w ..),
+            # anchors, group references or character codes (\x41, \101 ..) which end the literal
+            if escaped.isascii() and escaped and not escaped.isalnum():
+                i += 2
+                if depth == 0:
+                    run += escaped
+                continue
+            i += get_escape_size(regex, i)
+            runs.append(run)
+            run = ''
+            continue
+        if c in regex_special:
+            #The previous character is optional
+            if c in '*?{' and run:
+                run = run[:-1]
+            runs.append(run)
+            run = ''
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif c == '[':
+                #Skip the character class, ] right after [ or [^ is a literal ]
+                i += 1
+                if regex[i:i+1] == '^':
+                    i += 1
+                if regex[i:i+1] == ']':
+                    i += 1
+                while i < len(regex) and regex[i] != ']':
+                    i += 2 if regex[i] == '\\' else 1
+            elif c == '{':
+                i = regex.find('}', i)
+                if i == -1:
+                    return ''
+            i += 1
+            continue
+        if depth == 0:
+            run += c
+        i += 1
+    runs.append(run)
+    return max(runs, key=len)
+
+def get_regex_predicate(n, regex, match=True):
+    """
+    Return a predicate checking if field n matches (or does not match if match=False) the regex.
+    The regex is compiled once, and the rows without the literal part of the regex are
+    rejected with a substring check, without running the regex.
+    """
+    get = operator.itemgetter(n)
+    try:
+        search = re.compile(regex).search
+    except re.error as e:
+        raise ValueError("Invalid regex '{}': {}".format(regex, e))
+    literal = get_regex_literal(regex)
+    if literal:
+        def found(data):
+            value = get(data)
+            return literal in value and search(value) != None
+    else:
+        found = lambda data: search(get(data)) != None
+    if match:
+        return lambda data: n < len(data) and found(data)
+    return lambda data: n < len(data) and not found(data)
+
+class BloomFilter(object):
+    """
+    Bloom filter for `size` keys with a false positive rate of `error`.
+    Uses about -size*ln(error)/ln(2)^2 bits (1.2 MB for 1M keys at 1%), instead of
+    keeping the keys. Keys added are always found, keys not added are found with
+    probability `error`.
+    """
+    def __init__(self, size, error=0.01):
+        if not 0 < error < 1:
+            raise ValueError("Invalid false positive rate {}, it has to be between 0 and 1".format(error))
+        size = max(size, 1)
+        self.m = max(ceil(-size*log(error)/log(2)**2), 8)
+        self.k = max(round(self.m/size*log(2)), 1)
+        self.bits = bytearray((self.m+7)//8)
+
+    def get_positions(self, key):
+        #Double hashing, two 64 bit hashes give the k positions
+        h = blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], 'big')
+        h2 = int.from_bytes(h[8:], 'big') | 1
+        return [(h1 + i*h2) % self.m for i in range(self.k)]
+
+    def add(self, key):
+        for pos in self.get_positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.get_positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+def read_keys(filename):
+    """Yield the keys in filename, one key per line, with the spaces around it removed"""
+    with open(filename) as f:
+        for line in f:
+            key = line.strip()
+            if key:
+                yield key
+
+def load_keys(filename, bloom=None):
+    """
+    Load the keys in filename into a set, or into a BloomFilter with the false positive
+    rate bloom if it is given (the file is read twice, to count the keys first).
+    """
+    try:
+        if bloom != None:
+            keys = BloomFilter(sum(1 for i in read_keys(filename)), error=bloom)
+            for key in read_keys(filename):
+                keys.add(key)
+            return keys
+        return set(read_keys(filename))
+    except OSError as e:
+        raise ValueError("Cannot read keys from {}: {}".format(filename, e.strerror))
+
+def tokenize_filter(pattern):
+    """Split the filter pattern into a list of tokens"""
+    tokens = []
+    pos = 0
+    pattern = pattern.strip()
+    while pos < len(pattern):
+        m = filter_token_re.match(pattern, pos)
+        if not m or m.end() == pos:
+            raise ValueError("Invalid filter pattern at: {}".format(pattern[pos:]))
+        tokens.append(m.group().strip())
+        pos = m.end()
+    return tokens
+
+class FilterParser(object):
+    """
+    Recursive descent parser for the filter patterns, builds a predicate function
+    (row -> bool) from the pattern once, so that no parsing happens for each row.
+
+    Grammar:
+      expr      := and_expr (OR and_expr)*
+      and_expr  := not_expr (AND not_expr)*
+      not_expr  := NOT not_expr | ( expr ) | condition
+      condition := fN operator operand | fN in @file
+
+    bloom: float
+      False positive rate of the Bloom filters used for `in @file`, None uses sets
+    """
+    def __init__(self, pattern, bloom=None):
+        self.pattern = pattern
+        self.bloom = bloom
+        self.tokens = tokenize_filter(pattern)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token == None:
+            raise ValueError("Incomplete filter pattern: {}".format(self.pattern))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise ValueError("Empty filter pattern")
+        predicate = self.parse_or()
+        if self.peek() != None:
+            raise ValueError("Unexpected '{}' in filter pattern: {}".format(self.peek(), self.pattern))
+        return predicate
+
+    def parse_or(self):
+        predicate = self.parse_and()
+        while self.peek() == 'OR':
+            self.next()
+            predicate = or_predicate(predicate, self.parse_and())
+        return predicate
+
+    def parse_and(self):
+        predicate = self.parse_not()
+        while self.peek() == 'AND':
+            self.next()
+            predicate = and_predicate(predicate, self.parse_not())
+        return predicate
+
+    def parse_not(self):
+        token = self.peek()
+        if token == 'NOT':
+            self.next()
+            return not_predicate(self.parse_not())
+        if token == '(':
+            self.next()
+            predicate = self.parse_or()
+            if self.next() != ')':
+                raise ValueError("Missing ')' in filter pattern: {}".format(self.pattern))
+            return predicate
+        return self.parse_condition()
+
+    def parse_condition(self):
+        op1 = self.next()
+        if not (op1.startswith('f') and op1[1:].isdigit()):
+            raise ValueError("Expected a field fN, got '{}' in filter pattern: {}".format(op1, self.pattern))
+        opr = self.next()
+        op2 = self.next()
+        return self.get_condition(int(op1[1:]), opr, op2)
+
+    def get_condition(self, n, opr, op2):
+        if opr == 'in':
+            return get_in_condition(n, op2, bloom=self.bloom)
+        return get_condition(n, opr, op2)
+
+class ZoneFilterParser(FilterParser):
+    """
+    Parser for the filter patterns which builds a check of the zone map of a block of rows,
+    instead of a predicate for each row. The check takes zones (n -> (min, max, nulls) of
+    field n in the block, None if not known) and returns False if no row of the block can match.
+    Only the numeric conditions use the zone map, the other conditions and NOT can always match.
+    """
+    def parse_not(self):
+        if self.peek() == 'NOT':
+            self.next()
+            self.parse_not()
+            return lambda zones: True
+        return super().parse_not()
+
+    def get_condition(self, n, opr, op2):
+        return get_zone_condition(n, opr, op2)
+
+def and_predicate(left, right):
+    return lambda data: left(data) and right(data)
+
+def or_predicate(left, right):
+    return lambda data: left(data) or right(data)
+
+def not_predicate(predicate):
+    return lambda data: not predicate(data)
+
+def get_in_condition(n, op2, bloom=None):
+    """
+    Return a predicate for the condition `fn in @file`, true if field n is one of the
+    lines of file. The file is loaded once, each row is a single hash lookup.
+    """
+    #The file name can be wrapped under quotes
+    if op2[0] in ("'", '"') and op2[-1] == op2[0] and len(op2) > 1:
+        op2 = op2[1:-1]
+    if not op2.startswith('@') or len(op2) == 1:
+        raise ValueError("Operand of 'in' has to be @file, got '{}'".format(op2))
+    keys = load_keys(op2[1:], bloom=bloom)
+    get = operator.itemgetter(n)
+    return lambda data: n < len(data) and get(data) in keys
+
+def get_condition(n, opr, op2):
+    """
+    Return a predicate for the condition `fn opr op2`.
+    If op2 is wrapped under quotes it is a string, otherwise a number.
+    Rows where the field is missing or not a number do not match numeric conditions.
+    """
+    if op2[0] in ("'", '"') and op2[-1] == op2[0] and len(op2) > 1:
+        value = op2[1:-1]
+        if opr not in string_ops:
+            raise ValueError("Invalid string operator '{}', use one of {}".format(opr, ', '.join(string_ops)))
+        get = operator.itemgetter(n)
+        #Regex search
+        if opr in ('~', '!~'):
+            return get_regex_predicate(n, value, match=(opr == '~'))
+        #Substring match
+        elif opr == 'contains':
+            return lambda data: n < len(data) and value in get(data)
+        elif opr == 'startswith':
+            return lambda data: n < len(data) and get(data).startswith(value)
+        #Exact match
+        elif opr == '===':
+            return lambda data: n < len(data) and get(data) == value
+        elif opr == '!==':
+            return lambda data: n < len(data) and get(data) != value
+        #Case insensitive match
+        value = value.casefold()
+        if opr == '==':
+            return lambda data: n < len(data) and get(data).casefold() == value
+        return lambda data: n < len(data) and get(data).casefold() != value
+    if opr not in numeric_ops:
+        raise ValueError("Invalid numeric operator '{}', use one of {}".format(opr, ', '.join(numeric_ops)))
+    try:
+        value = float(op2)
+    except ValueError:
+        raise ValueError("Invalid number '{}', wrap strings under quotes".format(op2))
+    compare = numeric_ops[opr]
+    def condition(data):
+        try:
+            return compare(float(data[n]), value)
+        except (ValueError, IndexError):
+            return False
+    return condition
+
+def get_zone_condition(n, opr, op2):
+    """
+    Return a check of the zone map for the condition `fn opr op2`, False if no row of the
+    block can match. Blocks where field n has no numbers do not match numeric conditions.
+    """
+    check = zone_ops.get(opr)
+    if check == None or op2[0] in ("'", '"'):
+        return lambda zones: True
+    try:
+        value = float(op2)
+    except ValueError:
+        return lambda zones: True
+    def condition(zones):
+        zone = zones(n)
+        if zone == None:
+            return True
+        lo, hi, nulls = zone
+        if lo == None:
+            return False
+        return check(lo, hi, value)
+    return condition
+
+def compile_filter(pattern, bloom=None):
+    """
+    Compile the filter pattern into a function which takes a row (list of fields)
+    and returns True if the row matches the pattern.
+    bloom is the false positive rate of Bloom filters for `in @file`, None keeps the keys in sets.
+    """
+    return FilterParser(pattern, bloom=bloom).parse()
+
+def compile_zone_filter(pattern):
+    """
+    Compile the filter pattern into a function which takes the zone map of a block of rows
+    (n -> (min, max, nulls) of field n) and returns False if no row of the block can match.
+    """
+    return ZoneFilterParser(pattern).parse()
@@ -42,11 +42,74 @@ desc ['group'] = """
 Group columns (got from -r) and apply the aggregate functions (got from --aagfunc) on the data from columns (got from -v)
 """
 
+desc['aggfunc'] = """
+pN is the Nth percentile (p90, p99 ...). amedian and apN are approximate median and percentiles, computed
+using a KLL sketch which uses bounded memory for each group (about 600 values). The rank of the result
+is within about 1.65% of the requested rank with 99% confidence, groups with less than 200 values are exact (the same result as median and pN).
+nunique is the count of distinct values. anunique is an approximate count of distinct values using a
+HyperLogLog sketch with at most 4KB for each group, the standard error is about 1.6%.
+"""
+
+desc['merge'] = """
+Merge the aggregation states written by group, pivot or topn with --emit-state and print the result.
+The state files have to be created with the same options. State files are python pickles, only merge
+files from trusted sources.
+"""
+
+desc['ingest'] = """
+Split the input once and write it into a columnar cache file. Other actions read it with --from-cache FILE,
+only the fields they use are read and the rows are not split or parsed again.
+Use -d, -h1 and --skip-rows with ingest, the heading is kept in the cache. The cache files are python
+pickles, only read files from trusted sources.
+"""
+
 desc ['topn'] = """
 Find the top N (limted by -n) items (from -t column) for a group (from -r column) 
 based on the data (from values in -v column) by applying the aggregation function (using --aggfunc)
 """
 
+#Aggregation functions accepted by --aggfunc
+# pN -> Nth percentile, apN -> approximate Nth percentile (N is 0->100)
+aggfunc_l = ['first', 'last', 'concat', 'max', 'min', 'sum', 'count', 'mean', 'median', 'stdev',
+             'nunique', 'amedian', 'anunique']
+aggfunc_metavar = '{' + ','.join(aggfunc_l + ['pN', 'apN']) + '}'
+
+def aggfunc_type(f):
+    """Check the aggregation function passed in --aggfunc"""
+    if f in aggfunc_l:
+        return f
+    #Percentiles, pN or apN
+    p = f[2:] if f.startswith('ap') else f[1:]
+    if f.startswith('p') or f.startswith('ap'):
+        if p.isdigit() and int(p) <= 100:
+            return f
+    raise argparse.ArgumentTypeError("invalid choice: '{}' (choose from {})".format(f, aggfunc_metavar))
+
+def size_type(size):
+    """Check the size passed in --memory-limit"""
+    try:
+        return get_size_bytes(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{}' (use bytes or a number with K, M or G suffix, e.g. 500M)".format(size))
+
+def rank_key_type(key):
+    """Check a rank key passed in --rank-key, of the format N, N:asc or N:desc"""
+    try:
+        get_rank_keys([key])
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid rank key: '{}' (use N, N:asc or N:desc, e.g. 2:desc)".format(key))
+    return key
+
+def rate_type(rate):
+    """Check the false positive rate passed in --bloom, it has to be between 0 and 1"""
+    try:
+        value = float(rate)
+    except ValueError:
+        value = None
+    if value == None or not 0 < value < 1:
+        raise argparse.ArgumentTypeError("invalid rate: '{}' (use a number between 0 and 1, e.g. 0.01)".format(rate))
+    return value
+
 def parse_args():
     parser = argparse.ArgumentParser(description=desc.main)
 
@@ -84,6 +147,44 @@ def parse_args():
               'fast': [['--fast'],
                        {'action':'store_true',
                         'help': 'Attempts to be faster in producing the ascii table output, by pre-assuming cell widths of table. Use --width to set custom cell widths.'}],
+              'progressive': [['--progressive'],
+                              {'type': int, 'nargs': '?', 'const': 100, 'default': None, 'metavar': 'K',
+                               'help': 'Print the ascii table as the rows are read, using the cell widths of the first K rows (default K is 100). When a wider value comes up, the column is widened and the heading is printed again.'}],
+              'jobs': [['--jobs'], {'type': int,
+                                    'help': "Number of processes to run with. A single input has to be a file (not a pipe), it is split into byte ranges for each process. With several input files, each file is given to a process. Default is %(default)s",
+                                    'default': 1,
+                                    'metavar': 'N'}],
+              'emit_state': [['--emit-state'], {'type': str,
+                                                'help': "Write the aggregation state to FILE instead of printing the result. State files can be combined and printed with the merge action",
+                                                'default': None,
+                                                'metavar': 'FILE',
+                                                'dest': 'emit_state'}],
+              'line_buffered': [['--line-buffered'], {'action': 'store_true',
+                                                      'help': "Write each output line as soon as it is ready, instead of writing the output in large blocks. Useful when the output is watched live (eg: tail -f log | da ...)",
+                                                      'default': False,
+                                                      'dest': 'line_buffered'}],
+              'limit': [['--limit'], {'type': int,
+                                      'help': "Print only the first N rows of the result, input is not read after N rows are printed (sort keeps only the top N rows in memory)",
+                                      'default': None,
+                                      'metavar': 'N'}],
+              'file': [['file'], {'type': str,
+                                  'nargs': '*',
+                                  'help': "Input files or glob patterns (quote them to expand many files, eg: 'logs/*.gz'). gzip, bz2 and xz compressed files are decompressed while reading (detected from the first bytes, also for stdin). Regular files are memory mapped, each block of about 1MB is still copied out of the map and split into lines before the fields are picked. Default is to read stdin. Give the files before options which take multiple values (eg: -k, -r)",
+                                  'default': [],
+                                  'metavar': 'FILE'}],
+              'file_column': [['--file-column'], {'action': 'store_true',
+                                                  'help': "Add the name of the input file as field 0 (heading __file__), the fields of the input are numbered from 1",
+                                                  'default': False,
+                                                  'dest': 'file_column'}],
+              'decompress_thread': [['--decompress-thread'], {'action': 'store_true',
+                                                              'help': "Decompress the input in another thread, so that decompression overlaps with parsing",
+                                                              'default': False,
+                                                              'dest': 'decompress_thread'}],
+              'from_cache': [['--from-cache'], {'type': str,
+                                                'help': "Read the rows from a cache FILE written by the ingest action instead of the input. Only the fields used are read, and nothing is split or parsed again",
+                                                'default': None,
+                                                'metavar': 'FILE',
+                                                'dest': 'from_cache'}],
               'rich': [['--rich'],
                      {'action':'store_true',
                               'help': 'fancy table printing, only works if the rich python module is installed (Does not install by default).'}]}
@@ -99,24 +200,27 @@ def parse_args():
     #table; options
     tablegroup = actions.add_parser(name='table', help="Tabulate the input fields",
                                     description=desc.table)
-    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading']:
+    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'line_buffered', 'heading', 'skip_rows', 'h1', 'fast', 'progressive', 'rich', 'noheading', 'limit', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         tablegroup.add_argument(*args_d[i][0], **args_d[i][1])    
     
     #transpose: options
     transposegroup = actions.add_parser(name='transpose', help="Transpose rows into columns")
-    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading']:
+    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'line_buffered', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         transposegroup.add_argument(*args_d[i][0], **args_d[i][1]) 
 
     #filter: options
     filtergroup = actions.add_parser(name='filter', help="Filter rows from table based on condition")
-    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading']:
+    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'line_buffered', 'heading', 'skip_rows', 'h1', 'fast', 'progressive', 'rich', 'noheading', 'limit', 'jobs', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         filtergroup.add_argument(*args_d[i][0], **args_d[i][1]) 
-    filtergroup.add_argument('-p', '--pattern', type=str, help="Pattern to use to filter")
+    filtergroup.add_argument('-p', '--pattern', type=str, help="Pattern to use to filter, conditions of the form fN operator operand combined with AND, OR, NOT and parentheses. Eg: \"f1 > 10 AND (f2 == 'get' OR NOT f3 === 'Ok')\"")
     filtergroup.add_argument('--tag', action="store_true", help="Tag the row under column 'filtered' instead of filtering it out", default=False)
+    filtergroup.add_argument('--bloom', type=rate_type, metavar='RATE',
+                             help="Load the keys of 'fN in @file' into a Bloom filter with false positive RATE (between 0 and 1, eg: 0.01) instead of a set. Uses about 1.2MB for 1M keys at 0.01, but rows not in the file match with probability RATE",
+                             default=None)
 
     #sort: options
     sortgroup = actions.add_parser(name='sort', help="Sort table by column fields")
-    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading']:
+    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'line_buffered', 'heading', 'skip_rows', 'h1', 'fast', 'progressive', 'rich', 'noheading', 'limit', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         sortgroup.add_argument(*args_d[i][0], **args_d[i][1]) 
     sortgroup.add_argument('-k', '--sort-key', type=int, nargs='+', 
                             help='Choose the field numbers to sort by. Multiple field numbers can be give. L->R preference',
@@ -125,32 +229,41 @@ def parse_args():
                             help='Sort by descending order. Default is ascending',
                             default=False)
     sortgroup.add_argument('--numeric', action='store_true', 
-                            help='Treat data as numbers',
+                            help='Treat data as numbers, the cells which are not numbers are sorted and ranked below all the numbers',
                             default=False)
-    sortgroup.add_argument('--rank-key', type=int, nargs='+', 
-                            help='Choose the field numbers for which ranking is needed after sorting is complete. Should be a subset of sort keys (-k option)',
-                            default=[])
+    sortgroup.add_argument('--rank-key', type=rank_key_type, nargs='+', 
+                            help='Choose the field numbers for which ranking is needed after sorting is complete. Use N:asc or N:desc to choose the ranking direction of the field, default is the sort direction. Ranking the first sort key (-k option) does not need another sort',
+                            default=[],
+                            metavar='N[:asc|:desc]')
+    sortgroup.add_argument('--rank-method', type=str,
+                            help='Ranking method, competition (1224), dense (1223), ordinal (1234) or percent ((competition rank-1)/(rows-1)). Default is %(default)s',
+                            choices=['competition', 'dense', 'ordinal', 'percent'],
+                            default='competition')
     sortgroup.add_argument('--start-rank', type=int, 
                             help='Starting Rank number to use',
                             default=0)
+    sortgroup.add_argument('--memory-limit', type=size_type,
+                            help='Memory to use for sorting, e.g. 500M or 2G. Sorted runs of the input are written to a temporary file when the limit is reached, and merged while printing the output (64 runs at a time). Default is to sort in memory',
+                            default=None,
+                            metavar='SIZE')
 
     #Correlation opions
     corrgroup = actions.add_parser(name='corr', help="Create correlation matrix with the fields")
-    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading']:
+    for i in ['fields', 'tocsv', 'delim', 'pipe', 'pipewith', 'line_buffered', 'heading', 'skip_rows', 'h1', 'fast', 'rich', 'noheading', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         corrgroup.add_argument(*args_d[i][0], **args_d[i][1])  
 
     #summary: options
     aggregategroup = actions.add_parser(name='summary', help="Similar to pandas dataframe describe(), gives a statistical summary of the result, All values are treated as continous data")
-    for i in ['fields', 'delim', 'skip_rows', 'h1', 'heading', 'rich', 'noheading']:
+    for i in ['fields', 'delim', 'skip_rows', 'h1', 'heading', 'rich', 'noheading', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         aggregategroup.add_argument(*args_d[i][0], **args_d[i][1])
 
     #hist: options
     histgroup = actions.add_parser(name='hist', help="Get the histogram of the input fields",
                                    description=desc.hist)
-    for i in ['fields', 'delim', 'heading', 'skip_rows', 'h1', 'rich']:
+    for i in ['fields', 'delim', 'heading', 'skip_rows', 'h1', 'rich', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         histgroup.add_argument(*args_d[i][0], **args_d[i][1])
-    histgroup.add_argument('--min', type=int, help="the lowest of the bins. Default is the minimum of the data.", metavar='N')
-    histgroup.add_argument('--max', type=int, help="the highest of the bins, highest value in set. Default is the maximum of the data.", metavar='N')
+    histgroup.add_argument('--min', type=int, help="the lowest of the bins, lower values are not counted. Default is the minimum of the data.", metavar='N')
+    histgroup.add_argument('--max', type=int, help="the highest of the bins, higher values are not counted. Default is the maximum of the data.", metavar='N')
     histgroup.add_argument("--bins", type=int, nargs="+",
                            help="Specify the bins manually separated by space. They act as the upper edge of the bin. The lower edge is the previous bin or the lowest-1 value. Has to be intergers",
                            default=[])
@@ -162,16 +275,16 @@ def parse_args():
 
     #pivot: options
     pivotgroup = actions.add_parser(name='pivot', help="Pivot the input data",
-                                    description=desc.pivot)
-    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith']:
+                                    description=desc.pivot, epilog=desc.aggfunc)
+    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith', 'line_buffered', 'jobs', 'emit_state', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         pivotgroup.add_argument(*args_d[i][0], **args_d[i][1])
     pivotgroup.add_argument('-r', '--rowind', type=int, help="Position of the data that needs to be used as row index. Starts from 0",
                             metavar='N',
                             default=None)
     pivotgroup.add_argument('-c', '--columnind', type=int, help="Position of the data that needs to be used as column index. Starts from 0.", default=None, metavar='N')
     pivotgroup.add_argument('-v', '--valueind', type=int, help="Position of data that needs to be added as value to use on the cell. Starts from 0.", default=None, metavar='N')
-    pivotgroup.add_argument('--aggfunc', type=str, help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
-                            choices=['first', 'last', 'concat', 'max', 'min', 'sum', 'count', 'mean', 'median', 'stdev'],
+    pivotgroup.add_argument('--aggfunc', help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
+                            type=aggfunc_type, metavar=aggfunc_metavar,
                             default='first')
     pivotgroup.add_argument('--row_share', action='store_true',
                             help="Compute share of results of pivot table within each row.",
@@ -192,15 +305,15 @@ def parse_args():
 
     #group: options
     groupgroup = actions.add_parser(name='group', help="Group the input data by a column and run agg functions on the grouped data",
-                                    description=desc.group)
-    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith', 'noheading']:
+                                    description=desc.group, epilog=desc.aggfunc)
+    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith', 'line_buffered', 'noheading', 'jobs', 'emit_state', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         groupgroup.add_argument(*args_d[i][0], **args_d[i][1])
     groupgroup.add_argument('-r', '--rowind', nargs="+", type=int, help="Position of the data that needs to be used as row index. Starts from 0",
                             metavar='N',
                             default=[0])
     groupgroup.add_argument('-v', '--valueind', nargs="+", type=int, help="Position of data that needs to be added as value to use on the cell. Starts from 0.", default=[1], metavar='N')
-    groupgroup.add_argument('--aggfunc', nargs="+", type=str, help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
-                            choices=['first', 'last', 'concat', 'max', 'min', 'sum', 'count', 'mean', 'median', 'stdev'],
+    groupgroup.add_argument('--aggfunc', nargs="+", help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
+                            type=aggfunc_type, metavar=aggfunc_metavar,
                             default=['count'])
     #groupgroup.add_argument('--aggfunc', action="append", help="""function to run on the field. one field and one action is supported. 
     #Format is fieldNumber:function1,function2. fieldNumber is based on the input field number, and numbering starts from 0. 
@@ -208,8 +321,8 @@ def parse_args():
 
     #topn: options
     topngroup = actions.add_parser(name='topn', help="Find topN values",
-                                    description=desc.topn)
-    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith', 'noheading']:
+                                    description=desc.topn, epilog=desc.aggfunc)
+    for i in ['delim', 'heading', 'skip_rows', 'h1', 'rich', 'tocsv', 'pipe', 'pipewith', 'line_buffered', 'noheading', 'jobs', 'emit_state', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         topngroup.add_argument(*args_d[i][0], **args_d[i][1])
     topngroup.add_argument('-n', type=int, help="How many of topn to show",
                             metavar='N',
@@ -221,9 +334,34 @@ def parse_args():
                             metavar='N',
                             default=None)
     topngroup.add_argument('-v', '--valueind', nargs="+", type=int, help="Values to use to compute top of '-t' for each group from '-r'. Indexing starts from 0", default=None, metavar='N')
-    topngroup.add_argument('--aggfunc', nargs="+", type=str, help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
-                            choices=['first', 'last', 'concat', 'max', 'min', 'sum', 'count', 'mean', 'median', 'stdev'],
+    topngroup.add_argument('--aggfunc', nargs="+", help="Agg function to use if there are multiple values for the row x column combination. Default is %(default)s",
+                            type=aggfunc_type, metavar=aggfunc_metavar,
                             default=['count'])
+    topngroup.add_argument('--others', action='store_true',
+                            help="Add an 'others' column with the number of items that are not in the topn and the sum of their values, as count(sum)",
+                            default=False)
+    topngroup.add_argument('--approx', action='store_true',
+                            help="Use a bounded Space-Saving counter for each group instead of computing every (-r, -t) pair. Works with count and sum aggfunc. Counts can be overestimated, the maximum error for each group is shown in the max_error column",
+                            default=False)
+    topngroup.add_argument('--counters', type=int,
+                            help="Number of counters kept for each group with --approx. Default is 10 times -n",
+                            metavar='N',
+                            default=None)
+
+    #ingest: options
+    ingestgroup = actions.add_parser(name='ingest', help="Write the input into a cache file, to run other actions on it with --from-cache",
+                                     description=desc.ingest)
+    for i in ['delim', 'skip_rows', 'h1', 'file', 'file_column', 'decompress_thread']:
+        ingestgroup.add_argument(*args_d[i][0], **args_d[i][1])
+    ingestgroup.add_argument('--cache', type=str, required=True, metavar='FILE',
+                             help="Cache file to write")
+
+    #merge: options
+    mergegroup = actions.add_parser(name='merge', help="Merge aggregation states written using --emit-state",
+                                    description=desc.merge)
+    for i in ['rich', 'tocsv', 'pipe', 'pipewith', 'line_buffered', 'noheading', 'emit_state']:
+        mergegroup.add_argument(*args_d[i][0], **args_d[i][1])
+    mergegroup.add_argument('state_files', nargs='+', help="State files to merge", metavar='FILE')
 
     #transform: options
     transform_function_l = ['add', 'divide', 'div', 'floordiv', 'subtract', 'sub',
@@ -231,13 +369,16 @@ def parse_args():
                             'sample', 'concat']
     transform_function_l += custom_functions
     transformgroup = actions.add_parser(name='transform', help="Transform columns by running functions on them")
-    for i in ['delim', 'heading', 'skip_rows', 'h1', 'tocsv', 'pipe', 'pipewith', 'fields', 'noheading']:
+    for i in ['delim', 'heading', 'skip_rows', 'h1', 'tocsv', 'pipe', 'pipewith', 'line_buffered', 'fields', 'noheading', 'file', 'file_column', 'decompress_thread', 'from_cache']:
         transformgroup.add_argument(*args_d[i][0], **args_d[i][1])
     transformgroup.add_argument('--function', action="append", help="""function to run on the field. one field and one action is supported. 
     Format is fieldNumber:function:arguments. fieldNumber is based on the input field number, and numbering starts from 0. 
     Available functions are {}""".format(transform_function_l), metavar="format")
 
     args = vars(parser.parse_args())
+    #Space-Saving counters can only add up the values
+    if args.get('approx') and args.get('aggfunc') not in (['count'], ['sum']):
+        topngroup.error("--approx works only with a single aggfunc, count or sum")
     # If no options are provided, print the help
     if len(sys.argv) == 1:
         parser.print_help()
@@ -42,7 +42,10 @@ if __name__=='__main__':
     #Ouptut fields
     noheading = args.get('noheading')
     fast = args.get('fast')
+    progressive = args.get('progressive')
     rich = args.get('rich')
+    jobs = args.get('jobs')
+    emit_state = args.get('emit_state')
     tocsv = args.get('tocsv') 
     #Check if delims for output are passed
     pipewith = args.get('pipewith') #There will be a delimter here
@@ -60,8 +63,8 @@ if __name__=='__main__':
     #Action to do
     action = args.get('action') 
     #Hist fields
-    minv = args.get('minv')
-    maxv = args.get('maxv')
+    minv = args.get('min')
+    maxv = args.get('max')
     bins = args.get('bins')
     size = args.get('size')
     count = args.get('count')
@@ -78,9 +81,15 @@ if __name__=='__main__':
     colsummary = args.get('colsummary')
     row_share = args.get('row_share')
 
+    #merge fields
+    state_files = args.get('state_files')
+
     #topn fields
     topind = args.get('topind')
     n = args.get('n')
+    approx = args.get('approx')
+    counters = args.get('counters')
+    others = args.get('others')
 
     #Transform fields
     function = args.get('function')
@@ -91,10 +100,20 @@ if __name__=='__main__':
     rank_key = args.get('rank_key')
     numeric = args.get('numeric')
     start_rank = args.get('start_rank')
+    rank_method = args.get('rank_method')
+    memory_limit = args.get('memory_limit')
 
     #Filter fields
     pattern = args.get('pattern')
     tag = args.get('tag')
+    bloom = args.get('bloom')
+
+    #Rows to print for table, filter and sort
+    limit = args.get('limit')
+
+    #Output is written in large blocks, unless line buffering is asked for
+    # or the output is a terminal
+    writer.line_buffered = args.get('line_buffered') or sys.stdout.isatty()
 
     #Handle fields
     ##Common fields, prefer action's option first otherwise use the common option
@@ -138,6 +157,41 @@ if __name__=='__main__':
         fields = []
     fields = get_uniq_fields(fields)
 
+    #Input files, stdin by default
+    try:
+        src = get_input_files(args.get('file') or [])
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(-1)
+    #Named pipes and process substitution (/dev/fd/63) are read too, so the files are not opened
+    # to be checked, opening a pipe waits for the writer and closing it would stop the writer
+    for f in src:
+        if f == '-':
+            continue
+        if not os.path.exists(f):
+            problem = "no such file"
+        elif os.path.isdir(f):
+            problem = "is a directory"
+        elif not os.access(f, os.R_OK):
+            problem = "permission denied"
+        else:
+            continue
+        print("Cannot read the input file: {} ({})".format(f, problem), file=sys.stderr)
+        sys.exit(-1)
+    #A single input is read as is, several files are read one after the other (or in parallel with --jobs)
+    if len(src) < 2:
+        src = src[0] if src else '-'
+    decompress_thread = args.get('decompress_thread')
+    file_column = args.get('file_column')
+    #Rows from a cache file written by ingest
+    from_cache = args.get('from_cache')
+    if from_cache:
+        try:
+            Cache(from_cache)
+        except (OSError, ValueError) as e:
+            print("Cannot read the cache file {}: {}".format(from_cache, e), file=sys.stderr)
+            sys.exit(-1)
+
     #Creating the table object
     #handle pivot separately, rest is default Table object
     if action == 'pivot':
@@ -149,69 +203,91 @@ if __name__=='__main__':
         else:
             rowsummary = True
             colsummary = True
-        T = Table(src='-', delim=delim, fields=fields, h1=h1,
+        T = Table(src=src, delim=delim, fields=fields, h1=h1,
                   row_k=rowind, col_k=columnind,
                   val_k=valueind, f=aggfunc, summary=summary,
                   heading=heading, summaryf=summaryf, rowsummary=rowsummary,
                   colsummary=colsummary, skip_rows=skip_rows, action=action,
-                  row_share=row_share)
+                  row_share=row_share, jobs=jobs, emit_state=emit_state,
+                  decompress_thread=decompress_thread, file_column=file_column,
+                  from_cache=from_cache)
     elif action == 'group':
-        T = Table(src='-', delim=delim, fields=fields, h1=h1,
+        T = Table(src=src, delim=delim, fields=fields, h1=h1,
                   row_k=rowind, val_k=valueind, f=aggfunc, 
-                  heading=heading, skip_rows=skip_rows, action=action)
+                  heading=heading, skip_rows=skip_rows, action=action, jobs=jobs, emit_state=emit_state,
+                  decompress_thread=decompress_thread, file_column=file_column,
+                  from_cache=from_cache)
     elif action == 'topn':
-        T = Table(src='-', delim=delim, fields=fields, h1=h1,
+        T = Table(src=src, delim=delim, fields=fields, h1=h1,
                   row_k=rowind, val_k=valueind, f=aggfunc, 
-                  heading=heading, top_k=topind, n=n, skip_rows=skip_rows, action=action)
+                  heading=heading, top_k=topind, n=n, skip_rows=skip_rows, action=action,
+                  approx=approx, counters=counters, others=others, jobs=jobs, emit_state=emit_state,
+                  decompress_thread=decompress_thread, file_column=file_column,
+                  from_cache=from_cache)
+    elif action == 'merge':
+        try:
+            T = Table(state_files=state_files, emit_state=emit_state)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(-1)
+        #Continue as the action which created the states
+        action = T.action
     else:
-        T = Table(src='-', delim=delim, fields=fields, h1=h1, 
-                  heading=heading, skip_rows=skip_rows, action=action)
+        T = Table(src=src, delim=delim, fields=fields, h1=h1, 
+                  heading=heading, skip_rows=skip_rows, action=action, jobs=jobs,
+                  decompress_thread=decompress_thread, file_column=file_column,
+                  from_cache=from_cache)
+
+    #Write the aggregation state instead of the result
+    if emit_state:
+        T.save_state(emit_state)
+        sys.exit(0)
 
     #Actions to do
     #grouping
     if action == 'group':
         T.group()
         if fast:
-            print(T.fast_ascii_table())
+            T.fast_ascii_table()
         elif rich:
             out = rich_print_table(T.data, T.heading)
-            print(out)
+            writer.write(out)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         else:
-            print(T.to_ascii_table())
+            writer.write(T.to_ascii_table())
     
     #Finding Top n
     if action == 'topn':
         T.get_topn()
         if fast:
-            print(T.fast_ascii_table())
+            T.fast_ascii_table()
         elif rich:
             out = rich_print_table(T.data, T.heading)           
-            print(out)
+            writer.write(out)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         else:
-            print(T.to_ascii_table())
+            writer.write(T.to_ascii_table())
 
     #Pivoting
     if action == 'pivot':
         T.pivot()
         if fast:
-            print(T.fast_ascii_table())
+            T.fast_ascii_table()
         elif rich:
             out = rich_print_table(T.data, T.heading)
-            print(out)
+            writer.write(out)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         else:
-            print(T.to_ascii_table())
+            writer.write(T.to_ascii_table())
 
     #Transposing
     if action == 'transpose':
@@ -221,48 +297,45 @@ if __name__=='__main__':
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif fast:
-            #Handle BrokenPipeError
-            # https://stackoverflow.com/a/26738736
-            try:
-                print(T.fast_ascii_table(), flush=True)
-            except (BrokenPipeError):
-                pass
-            sys.stderr.close()
+            T.fast_ascii_table()
         else:
             if rich:
                 out = rich_print_table(T.data, T.heading)
-                print(out)
+                writer.write(out)
                 if out == None:
-                    print(T.to_ascii_table(), flush=True)
+                    writer.write(T.to_ascii_table())
             else:
-                print(T.to_ascii_table(), flush=True)    
+                writer.write(T.to_ascii_table())    
     
     #Simple ASCII Table
     if not action or action == 'table':
+        if limit != None:
+            T.limit_rows(limit)
         if pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif fast:
-            #Handle BrokenPipeError
-            # https://stackoverflow.com/a/26738736
-            try:
-                print(T.fast_ascii_table(), flush=True)
-            except (BrokenPipeError):
-                pass
-            sys.stderr.close()
+            T.fast_ascii_table()
+        elif progressive:
+            T.progressive_ascii_table(sample=progressive)
         else:
             if rich:
                 out = rich_print_table(T.data, T.heading)
-                print(out)
+                writer.write(out)
                 if out == None:
-                    print(T.to_ascii_table(), flush=True)
+                    writer.write(T.to_ascii_table())
             else:
-                print(T.to_ascii_table(), flush=True)        
+                writer.write(T.to_ascii_table())        
+
+    #Write the rows into a cache file
+    if action == 'ingest':
+        rows, columns = write_cache(T, args.get('cache'))
+        writer.write("Wrote {} rows with {} fields to {}".format(rows, columns, args.get('cache')))
 
     #Summarising
     if action == 'summary':
-        data = T.get_fields(fields)
+        data = T.get_fields(fields, typed=True)
         result = []
         summary_data_continous = {'heading': [], 'data': []}
         summary_data_categorical = {'heading': [], 'data': []}
@@ -282,115 +355,70 @@ if __name__=='__main__':
             Tsum = Table(data=summary_data_continous['data'],
                          heading=summary_data_continous['heading'])
             if rich:
-                print(rich_print_table(summary_data_continous['data'],
+                writer.write(rich_print_table(summary_data_continous['data'],
                                    summary_data_continous['heading']))
             else:
-                print(Tsum.to_ascii_table(repeat_heading=30))
+                writer.write(Tsum.to_ascii_table(repeat_heading=30))
         if summary_data_categorical['data']:
             Tsum = Table(data=summary_data_categorical['data'],
                          heading=summary_data_categorical['heading'])
             if rich:
-                print(rich_print_table(summary_data_categorical['data'],
+                writer.write(rich_print_table(summary_data_categorical['data'],
                                    summary_data_categorical['heading']))
             else:
-                print(Tsum.to_ascii_table(repeat_heading=30))
+                writer.write(Tsum.to_ascii_table(repeat_heading=30))
         
     #Transforming
     if action == 'transform':
-        pTable = T.get_fields(fields)
-        tTable = ColumnTable(name='Transformed')
-        for pk, pv in pTable.items():
-            pCol = Column(pv[1], name=pv[0], categorical=True)
-            tTable.add(pCol)
-        #Each item in t_list is the parsed transform string of --function input
-        # which defines the actions to follow 
-        for t in t_list:
-            #Not needed: Get the column name, or use dummy name created by the function-name and (a,b) 
-            #name = t.get('alias', '{}({},{})'.format(t['func'],
-            #                                         'a', 'b'))
-
-            #If param is a number, use it, if it's a field, get the Column object of that field
-            if t['is_field']:
-                t['params'] = Column(pTable[t['params']][1], name=pTable[t['params']][0])
-            else:
-                t['params'] = t['params']
-            # Hack to check if it is a categorical column
-            #Check if 'params' can be converted into float
-            categorical = False
-            if not t['is_field']:            
-                try:
-                    #If it can be, then its likely a numerical column
-                    params = float(t['params'])
-                except ValueError:
-                    #Else its intended to be a categorical column
-                    params = t['params']
-                    categorical = True
-            else:
-                params = t['params']
-            #Get the data for the fields where transform needs to be applied
-            # and create a column object, name it using alias key
-            if isinstance(t['params'], (Column)):
-                param_name = t['params'].name
-            else:
-                param_name = t['params']
-            #If column name is not defined, create one of the format func(a,b)
-            # a is field/col name
-            # b can be param of field/col name
-            if t['alias'] == '':
-                t['alias'] = '{}({},{})'.format(t['func'],
-                                                 pTable[t['fields'][0]][0],
-                                                 param_name)
-            #Create the column
-            #pTable(fieldN) -> gets the data
-            # fieldN is the field on which we start the transformation
-            tCol = Column(pTable[t['fields'][0]][1],
-                          name=t['alias'],
-                          categorical=categorical)
-            #Apply transform to the column
-            tCol.apply_transform(t['func'],
-                                 params)
-            #If there is a chain function, follow the same process as above one-after-another
-            if t['chain']:
-                for c in t['chain']:
-                    #If param is a number, use it, if it's a field, get the Column object of that field
-                    if c['is_field']:
-                        c['params'] = Column(pTable[c['params']][1])
-                    else:
-                        c['params'] = c['params']
-                    tCol.apply_transform(c['func'], c['params'])
-            #Add the transformed columns into the table
-            tTable.add(tCol)
-        #output formatting
-        if pipe:
-            tTable.pipe(disable_heading=noheading, delim=pipe)
-        elif tocsv:
-            tTable.tocsv(disable_heading=noheading)
+        #Element-wise transforms are run on chunks of rows, so that pipe/tocsv output is streamed
+        # Others need the whole column (cumsum, share, shift ..)
+        if (pipe or tocsv) and all(is_rowwise_transform(t) for t in t_list):
+            chunk_size = 1000
         else:
-            print(tTable.to_ascii_table(), flush=True)
+            chunk_size = None
+        for n, pTable in enumerate(T.get_field_chunks(fields, size=chunk_size)):
+            tTable = transform_fields(pTable, t_list)
+            #Print heading only with the first chunk
+            #output formatting
+            if pipe:
+                tTable.pipe(disable_heading=noheading or n > 0, delim=pipe)
+            elif tocsv:
+                tTable.tocsv(disable_heading=noheading or n > 0)
+            else:
+                writer.write(tTable.to_ascii_table())
 
     #Histogram
     if action == 'hist':
         #Gather all arguments, passing it as **kwargs to functions
         kwargs = {'minv': minv, 'maxv': maxv, 'count': count,
                   'bin_size': size, 'bins': bins}
-        #Get only the data from the fields
-        Tdata = T.get_fields(fields)
+        #Get only the data from the fields, the blocks of a cache outside --min/--max are skipped
+        value_range = None if minv == None and maxv == None else (minv, maxv)
+        Tdata = T.get_fields(fields, typed=True, value_range=value_range)
         asciigraph = True
         #k->field number; v -> [column_name, [values]]
         for Ck, Cv in Tdata.items():
             #The column name
             name = Cv[0]
             C = Column(data=Cv[1], name=name)
-            data = list(filter(lambda x: not isnan(x), C.data))
+            numbers = list(C.store.valid_numbers())
+            #Only the numbers within --min/--max are counted
+            if value_range != None:
+                data = [x for x in numbers if (minv == None or x >= minv) and (maxv == None or x <= maxv)]
+            else:
+                data = numbers
             heading=['bins', 'count', 'share%', 'cumshare%']
+            #No numbers within --min/--max (the blocks of a cache outside them were skipped)
+            if (numbers or C.store.skipped_numbers) and not data or not len(C):
+                continue
             #Categorical columns will return nan, so data is [], so we will use counter
             if not data:
                 #Initialise a list to collect the rows
                 hist_table = []
-                counter = Counter(Cv[1])
+                counter = C.store.count_strings()
                 cumshare = 0
                 for k, v in counter.items():
-                    share = int(v)/len(Cv[1])*100
+                    share = int(v)/len(C)*100
                     cumshare += share
                     row = [k, v, round(share, 2), round(cumshare, 2)]
                     if asciigraph:
@@ -426,48 +454,61 @@ if __name__=='__main__':
             if asciigraph:
                 heading.append("histogram")
             if rich:
-                print(rich_print_table(data=hist_table, heading=heading, title=title, justify={0: 'left', 4: 'left'}))
+                writer.write(rich_print_table(data=hist_table, heading=heading, title=title, justify={0: 'left', 4: 'left'}))
             else:
-                print(title)
+                writer.write(title)
                 #Print the table
                 hT = Table(data=hist_table, heading=heading)
-                print(hT.to_ascii_table())
+                writer.write(hT.to_ascii_table())
 
     #Filtering rows
     if action == 'filter':
-        T.filterrows(pattern, tag=tag)
+        try:
+            T.filterrows(pattern, tag=tag, bloom=bloom)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(-1)
+        if limit != None:
+            T.limit_rows(limit)
         if fast:
-            print(T.fast_ascii_table())
+            T.fast_ascii_table()
+        elif progressive:
+            T.progressive_ascii_table(sample=progressive)
         elif rich:
             out = rich_print_table(T.data, T.heading)
-            print(out)
+            writer.write(out)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         else:
-            print(T.to_ascii_table(), flush=True)  
+            writer.write(T.to_ascii_table())  
     
     #Sorting rows by column
     if action == 'sort':
-        T.sort(key=sort_key, reverse=reverse, numeric=numeric)
+        T.sort(key=sort_key, reverse=reverse, numeric=numeric, memory_limit=memory_limit,
+               limit=limit)
         if len(rank_key) > 0:
-            T.rank(key=rank_key, reverse=reverse, numeric=numeric, start_rank=start_rank)
+            rank_key, rank_reverse = get_rank_keys(rank_key, reverse=reverse)
+            T.rank(key=rank_key, reverse=rank_reverse, numeric=numeric, start_rank=start_rank,
+                   method=rank_method)
         if fast:
-            print(T.fast_ascii_table())
+            T.fast_ascii_table()
+        elif progressive:
+            T.progressive_ascii_table(sample=progressive)
         elif rich:
             out = rich_print_table(T.data, T.heading)
-            print(out)
+            writer.write(out)
         elif tocsv:
             T.tocsv(disable_heading=noheading)
         elif pipe:
             T.pipe(disable_heading=noheading, delim=pipe)
         else:
-            print(T.to_ascii_table(), flush=True) 
+            writer.write(T.to_ascii_table()) 
 
     if action == 'corr':
         #Get only the data from the fields
-        Tdata = T.get_fields(fields)
+        Tdata = T.get_fields(fields, typed=True)
         cor_d = defaultdict(dict)
         for i in combinations(fields, 2):
             x = i[0]
@@ -1,4 +1,18 @@
-from math import nan, ceil, floor, sqrt
+from math import nan, inf, ceil, floor, sqrt, fsum
+import os
+import re
+import sys
+import atexit
+import stat
+import pickle
+import tempfile
+import glob
+import mmap
+import gzip
+import bz2
+import lzma
+from queue import Queue
+from threading import Thread
 import statistics as stats
 from io import BytesIO #Convert image into bytes
 import base64 #For image base64 code
@@ -6,7 +20,8 @@ import base64 #For image base64 code
 import shlex 
 import subprocess
 from importlib import import_module
-from itertools import chain, zip_longest
+from itertools import chain, zip_longest, islice
+from heapq import merge
 from collections import defaultdict
 
 def check_module(module_name, install=False):
@@ -98,6 +113,423 @@ def convert_float(x):
     else:
         return out
     
+def get_number_key(x):
+    """
+    Return x as a float to sort or rank by, -inf if it is not a number.
+    nan is not equal to itself and breaks the order, -inf keeps the cells which are not numbers together
+    """
+    try:
+        number = float(x)
+    except ValueError:
+        return -inf
+    return -inf if number != number else number
+
+def get_size_bytes(size):
+    """
+    Convert a size like 500K, 100M or 2G (powers of 1024, B for bytes) to the number of bytes.
+    A plain number is taken as bytes.
+    """
+    units = {'B': 1, 'K': 1<<10, 'M': 1<<20, 'G': 1<<30, 'T': 1<<40}
+    size = str(size).strip().upper()
+    if size and size[-1] in units:
+        return int(float(size[:-1])*units[size[-1]])
+    return int(size)
+
+def get_row_size(row):
+    """
+    Approximate memory used by a row (list of str) in bytes, with its slots in the list of rows
+    and in the list of sort keys. Strings of one character are shared by python and are not counted.
+    """
+    return sys.getsizeof(row) + 16 + sum([sys.getsizeof(x) for x in row if len(x) > 1])
+
+def get_key_size(key):
+    """
+    Approximate memory used by a sort key in bytes. The numbers (and the list or tuple of them)
+    are created for the key, the strings are the cells of the row and are not counted.
+    """
+    if isinstance(key, str):
+        return 0
+    if isinstance(key, (list, tuple)):
+        return sys.getsizeof(key) + sum(map(get_key_size, key))
+    return sys.getsizeof(key)
+
+#Most runs merged at once, more runs are merged in passes
+merge_fan_in = 64
+
+class SortRuns(object):
+    """
+    Sorted runs of an external sort. All the runs are written to one anonymous temporary file,
+    so that a single file is open whatever the number of runs. The rows are pickled in chunks of
+    chunk_size rows, each with its size before it, so that a run is read back one chunk at a time.
+    """
+    def __init__(self, chunk_size=1000):
+        self.f = tempfile.TemporaryFile(buffering=0)
+        self.fd = self.f.fileno()
+        self.size = 0
+        self.chunk_size = chunk_size
+
+    def write_run(self, rows):
+        """Write the sorted rows (any iterable) as a new run, returns the run (start, end)"""
+        start = self.size
+        rows = iter(rows)
+        chunk = list(islice(rows, self.chunk_size))
+        while chunk:
+            data = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+            os.pwrite(self.fd, len(data).to_bytes(8, 'little') + data, self.size)
+            self.size += 8 + len(data)
+            chunk = list(islice(rows, self.chunk_size))
+        return (start, self.size)
+
+    def read_run(self, run):
+        """Yield the rows of a run written by write_run"""
+        pos, end = run
+        while pos < end:
+            size = int.from_bytes(os.pread(self.fd, 8, pos), 'little')
+            yield from pickle.loads(os.pread(self.fd, size, pos + 8))
+            pos += 8 + size
+
+    def merge_runs(self, runs, key=None, reverse=False, last=()):
+        """
+        Yield the merged rows of the runs and of the sorted rows last, ties keep the order of the
+        runs (last is after them). At most merge_fan_in runs are read at once: while there are
+        more, consecutive runs are merged into bigger runs, merge_fan_in at a time.
+        The file is closed at the end.
+        """
+        try:
+            while len(runs) >= merge_fan_in:
+                runs = [self.write_run(merge(*map(self.read_run, runs[i:i+merge_fan_in]), key=key, reverse=reverse))
+                        for i in range(0, len(runs), merge_fan_in)]
+            yield from merge(*map(self.read_run, runs), iter(last), key=key, reverse=reverse)
+        finally:
+            self.f.close()
+
+class Writer(object):
+    """
+    Buffered writer for the output lines. Lines are collected and written to stdout in
+    large writes, instead of a write (and flush) for each line. With line_buffered, each
+    line is written immediately, for interactive use (eg: tail -f log | da ...).
+
+    BrokenPipeError (eg: da ... | head) is handled here for all the output, the rest of
+    the output is dropped and the script exits.
+    """
+    def __init__(self, stream=None, line_buffered=False, buffer_size=1<<16):
+        self.stream = stream
+        self.line_buffered = line_buffered
+        self.buffer_size = buffer_size
+        self.lines = []
+        self.size = 0
+        #Write the pending lines when the script ends
+        atexit.register(self.close)
+
+    def write(self, line=''):
+        """Write a line, a newline is added at the end (like print)"""
+        if not isinstance(line, str):
+            line = str(line)
+        self.lines.append(line)
+        self.size += len(line)
+        if self.line_buffered or self.size >= self.buffer_size:
+            self.flush()
+
+    def writelines(self, lines):
+        """Write each line from the iterable lines"""
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """Write the collected lines to the stream"""
+        if not self.lines:
+            return
+        data = '\n'.join(self.lines) + '\n'
+        self.lines = []
+        self.size = 0
+        stream = self.stream or sys.stdout
+        try:
+            #Write the bytes directly, after anything printed to the text layer
+            if hasattr(stream, 'buffer'):
+                stream.flush()
+                stream.buffer.write(data.encode(stream.encoding, stream.errors))
+                if self.line_buffered:
+                    stream.buffer.flush()
+            else:
+                stream.write(data)
+                if self.line_buffered:
+                    stream.flush()
+        except BrokenPipeError:
+            self.broken_pipe()
+
+    def close(self):
+        self.flush()
+        try:
+            (self.stream or sys.stdout).flush()
+        except BrokenPipeError:
+            self.broken_pipe()
+
+    def broken_pipe(self):
+        #The reader of the output has exited, drop the output
+        # Point stdout to devnull so that python does not fail again when flushing stdout at exit
+        # https://docs.python.org/3/library/signal.html#note-on-sigpipe
+        self.lines = []
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+#All the output is written using this
+writer = Writer()
+
+def get_input_files(patterns):
+    """
+    Expand the input file arguments into a list of files. Arguments with *, ? or [ are expanded
+    using glob (sorted by name), so that they work when quoted too, which avoids
+    the argument length limits of the shell for many files.
+    Raises ValueError if a pattern does not match any file.
+    """
+    files = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise ValueError("No input files match: {}".format(pattern))
+            files += matches
+        else:
+            files.append(pattern)
+    return files
+
+def get_src_size(src):
+    """
+    Return the size in bytes of src ('-' for stdin, or a file path) if it is a regular file.
+    Returns None for pipes, terminals etc. and compressed files, as they cannot be split into byte ranges.
+    """
+    try:
+        if src == '-':
+            info = os.fstat(0)
+        else:
+            info = os.stat(src)
+    except (OSError, ValueError):
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    #Compressed files cannot be split into byte ranges either
+    fd = 0 if src == '-' else os.open(src, os.O_RDONLY)
+    try:
+        if get_compression(os.pread(fd, compression_magic_size, 0)) != None:
+            return None
+    finally:
+        if fd != 0:
+            os.close(fd)
+    return info.st_size
+
+def get_byte_ranges(size, count):
+    """Split size bytes into count ranges of (start, end)"""
+    step = max(ceil(size/count), 1)
+    return [(start, min(start+step, size)) for start in range(0, size, step)]
+
+#Magic bytes at the start of compressed files, and the module to open them with
+#First bytes of the compressed formats. bz2 is 'BZh', the block size 1-9 and the magic of
+# the first block (or of the end of the stream for an empty file), so that text starting with 'BZh' is not taken as bz2
+compression_magic = [(re.compile(b'\x1f\x8b'), gzip),
+                     (re.compile(b'BZh[1-9](?:1AY&SY|\x17rE8P\x90)'), bz2),
+                     (re.compile(b'\xfd7zXZ\x00'), lzma)]
+#Bytes needed to detect the compression
+compression_magic_size = 10
+
+def get_compression(head):
+    """Return the module (gzip, bz2 or lzma) to decompress data starting with the bytes head, None if it is not compressed"""
+    for magic, module in compression_magic:
+        if magic.match(head):
+            return module
+    return None
+
+def is_regular_file(f):
+    """Return True if the file object f reads from a regular file (also through a decompressor)"""
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (OSError, ValueError, AttributeError):
+        return False
+
+def open_src(src):
+    """
+    Open src ('-' for stdin, or a file path) for reading bytes.
+    gzip, bz2 and xz compressed input is detected from its first bytes and decompressed
+    while it is read.
+    """
+    if src == '-':
+        f = sys.stdin.buffer
+    else:
+        f = open(src, 'rb')
+    #peek does not consume the bytes, so it works on pipes too
+    module = get_compression(f.peek(compression_magic_size)[:compression_magic_size])
+    if module == None:
+        return f
+    #Pipes (stdin, named pipes, /dev/fd/63 ..) cannot be opened again, the bytes read by peek would be lost
+    if f is sys.stdin.buffer or not is_regular_file(f):
+        return module.open(f, 'rb')
+    f.close()
+    return module.open(src, 'rb')
+
+def read_blocks(f, block_size=1<<20):
+    """
+    Yield blocks of bytes read from f with readinto into one reused buffer.
+    A block is only valid until the next block is read.
+    Pipes and terminals are read with read1, which returns the bytes available
+    instead of waiting for a full block, so that streamed input is not held back.
+    """
+    if not is_regular_file(f):
+        while True:
+            block = f.read1(block_size)
+            if not block:
+                return
+            yield block
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    try:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return
+            yield view[:n]
+    finally:
+        view.release()
+
+def read_blocks_in_thread(f, block_size=1<<20, queue_size=4):
+    """
+    Yield blocks of bytes read from f by another thread, which reads (and decompresses) the
+    next blocks while the current one is parsed. zlib, bz2 and lzma release the GIL while
+    decompressing, so the two overlap. At most queue_size blocks are read ahead.
+    Pipes and terminals are read with read1, as in read_blocks.
+    """
+    queue = Queue(maxsize=queue_size)
+    read = f.read if is_regular_file(f) else f.read1
+    def reader():
+        try:
+            while True:
+                block = read(block_size)
+                queue.put(block)
+                if not block:
+                    return
+        except Exception as e:
+            queue.put(e)
+    #daemon, so that a reader blocked on a full queue does not keep the script running
+    Thread(target=reader, daemon=True).start()
+    while True:
+        block = queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            return
+        yield block
+
+def read_lines(src, block_size=1<<20, threaded=False):
+    """
+    Read the lines of src ('-' for stdin, or a file path) as bytes, without the newline.
+    The input is read in large blocks and each block is split into lines at once, instead
+    of going through the text layer line by line. Decoding is left to the caller.
+    Compressed input is decompressed while it is read (see open_src), in another thread
+    if threaded is True. Other regular files are memory mapped (see read_mmap_lines).
+    """
+    if not threaded:
+        mm = open_mmap(src)
+        if mm != None:
+            with mm:
+                yield from read_mmap_lines(mm, 0, None, block_size)
+            return
+    f = open_src(src)
+    if threaded:
+        blocks = read_blocks_in_thread(f, block_size)
+    else:
+        blocks = read_blocks(f, block_size)
+    #The partial line at the end of the previous block
+    rest = b''
+    try:
+        for block in blocks:
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+def open_mmap(src):
+    """
+    Memory map src ('-' for stdin, or a file path) for reading, if it is a regular file which is
+    not compressed and not empty. Returns None otherwise (pipes, compressed files ...).
+    The pages are read by the OS as they are used, and are shared by the forked worker processes.
+    """
+    if get_src_size(src) in (None, 0):
+        return None
+    #stdin which is already partly read is not mapped
+    if src == '-' and os.lseek(0, 0, os.SEEK_CUR) != 0:
+        return None
+    fd = 0 if src == '-' else os.open(src, os.O_RDONLY)
+    try:
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        if fd != 0:
+            os.close(fd)
+
+def get_line_start(mm, pos):
+    """Return the position of the first line starting at or after pos in mm (len(mm) if there is none)"""
+    if pos <= 0:
+        return 0
+    i = mm.find(b'\n', pos-1)
+    if i == -1:
+        return len(mm)
+    return i+1
+
+def get_line_ranges(src, count):
+    """
+    Split src into count byte ranges of (start, end) aligned to the start of lines, so that
+    each range has whole lines. Returns None if src cannot be memory mapped (see open_mmap).
+    """
+    mm = open_mmap(src)
+    if mm == None:
+        return None
+    with mm:
+        size = len(mm)
+        starts = sorted(set(get_line_start(mm, start) for start, end in get_byte_ranges(size, count)))
+    return [(start, end) for start, end in zip(starts, starts[1:] + [size]) if start < end]
+
+def read_mmap_lines(mm, start=0, end=None, block_size=1<<20):
+    """
+    Yield the lines starting in the byte range [start, end) of the memory map mm as bytes,
+    without the newline. A line starting in the range is read till its end even if it crosses
+    `end`, and a line which started before `start` is left to the previous range.
+    Blocks of about block_size ending at a newline are copied out of the map and split at once,
+    so each line is still a bytes object before the fields are picked. Finding the fields
+    in the map itself (re.finditer on the map) was measured slower than splitting the copied
+    block (0.36s vs 0.15s for 200k lines of 45 fields), the split runs in C for the whole block.
+    """
+    size = len(mm)
+    start = get_line_start(mm, start)
+    end = size if end == None else get_line_start(mm, end)
+    while start < end:
+        #End the block after the last newline in it, or after the line if it is longer than the block
+        stop = mm.rfind(b'\n', start, min(start+block_size, end)) + 1
+        if stop <= start:
+            stop = mm.find(b'\n', start, end) + 1 or end
+        #Without the newline at the end of the block (the last line of the file can be without one)
+        if mm[stop-1:stop] == b'\n':
+            yield from mm[start:stop-1].split(b'\n')
+        else:
+            yield from mm[start:stop].split(b'\n')
+        start = stop
+
+def read_range(src, start, end, block_size=1<<20):
+    """
+    Read the lines starting in the byte range [start, end) of src ('-' for stdin, or a file path).
+    A line starting in the range is read till its end even if it crosses `end`, and a line
+    which started before `start` is left to the previous range, so that the ranges of a file
+    together read every line once.
+    The file is memory mapped (see read_mmap_lines), so the offset of stdin is not changed.
+    The lines are bytes, without the newline (see read_lines).
+    """
+    mm = open_mmap(src)
+    if mm == None:
+        return
+    with mm:
+        yield from read_mmap_lines(mm, start, end, block_size)
+
 def get_uniq_fields(fields):
     """
     Remove duplicate fields. Preserves the order, only the first occurence is considered.
@@ -151,7 +583,8 @@ def f_aggfunc(data, aggfunc, need_sort=False, rounding=3):
     Define functions to run on a list.
     Available: first, last, concat, max, min, sum, count, 
                mean, average, avg, median, p50, pN (N is any interger (0->100),
-               stddev
+               stddev, stdev, amedian, apN (approximate median and percentiles,
+               computed exactly on a list), nunique, anunique (distinct count)
     Any other agg function returns a None
 
     Parameters
@@ -186,6 +619,9 @@ def f_aggfunc(data, aggfunc, need_sort=False, rounding=3):
     # gives the count of all rows
     if aggfunc == 'count':
         return len(data)
+    #Count of distinct values, approximate one is exact on a list
+    if aggfunc in ('nunique', 'anunique'):
+        return len(set(data))
     #Handle aggfunc is None, return the first data point
     if not aggfunc:
         return data[0]
@@ -202,16 +638,23 @@ def f_aggfunc(data, aggfunc, need_sort=False, rounding=3):
         return max(data)
     if aggfunc == 'min':
         return min(data)
+    #Exact sums, the same as the running sums of the aggregation states
     if aggfunc == 'sum':
-        return round(sum(data), 2)
+        return round(fsum(data), 2)
     if aggfunc in ('mean', 'average', 'avg'):
-        return round(sum(data)/len(data), 2)
+        return round(fsum(data)/len(data), 2)
+    #The approximate functions are for streams, on a list compute them exactly
+    if aggfunc == 'amedian':
+        aggfunc = 'median'
+    elif aggfunc.startswith('ap'):
+        aggfunc = aggfunc[1:]
     if aggfunc in ('median', 'p50'):
         return stats.median(data)
     if aggfunc.startswith('p'):
         p = int(aggfunc[1:])/100
-        return data[int(p*len(data))]
-    if aggfunc in ('stddev'):
+        #p100 is the last item
+        return data[min(int(p*len(data)), len(data)-1)]
+    if aggfunc in ('stddev', 'stdev'):
         return round(stats.pstdev(data), rounding)
     if aggfunc in ('diff'):
         return round(max(data)-min(data), rounding)
@@ -301,6 +744,34 @@ def get_fields(fields):
             all_fields.append(int(f))
     return all_fields
 
+def get_rank_keys(rank_keys, reverse=False):
+    """
+    Parse the rank keys of the format N, N:asc or N:desc
+    N is the field number, asc/desc is the direction of ranking for that field. 
+    If the direction is not given, reverse is used.
+
+    Returns
+    -------
+    tuple
+       list of field numbers, list of reverse (True for desc) for each field
+
+    Raises ValueError if a key is not of this format
+    """
+    keys = []
+    reverse_l = []
+    for k in rank_keys:
+        field, sep, direction = str(k).partition(':')
+        if not field.isdigit() or direction not in ('asc', 'desc') and (sep or direction):
+            raise ValueError("Invalid rank key: '{}'".format(k))
+        keys.append(int(field))
+        if direction == 'desc':
+            reverse_l.append(True)
+        elif direction == 'asc':
+            reverse_l.append(False)
+        else:
+            reverse_l.append(reverse)
+    return keys, reverse_l
+
 #Histogram related functions
 def create_if_not_exists(d, i, t=None):
     """
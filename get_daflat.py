@@ -19,12 +19,15 @@ import da_tool
 import da_custom
 import da_graphs
 import da_help
+import da_agg
+import da_filter
+import da_cache
 
 #We need the shebang line and the header line on top
 output_data = header
 #Add source code of each file
 # da_custom should be at first, as the transform custom functions need to be in global scope
-files = [da_custom, da_help, da_utils, da_classes, da_tool]
+files = [da_custom, da_help, da_utils, da_agg, da_filter, da_cache, da_classes, da_tool]
 for f in files:
     source = inspect.getsource(f)
     #If it contains "from da", ignore that line, as we are importing
@@ -0,0 +1,335 @@
+#Regression checks for da, run with: python3 -m unittest test_da
+#Only the default libraries are used, the checks run da_tool.py like a user would
+import os
+import sys
+import re
+import bz2
+import select
+import resource
+from random import Random
+from threading import Thread
+import tempfile
+import unittest
+import subprocess
+from statistics import median
+from math import sqrt
+#Importing from da_* should be from da_* import *
+from da_agg import *
+from da_filter import *
+from da_cache import *
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def run_da(args, stdin=None, script='da_tool.py'):
+    """Run da with the list of args, returns (returncode, stdout, stderr)"""
+    p = subprocess.run([sys.executable, os.path.join(here, script)] + args, input=stdin,
+                       capture_output=True, text=True)
+    return p.returncode, p.stdout, p.stderr
+
+class DaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'w') as fd:
+            fd.write(text)
+        return path
+
+class TestFilter(DaTestCase):
+    def test_tag_heading(self):
+        path = self.write('t.txt', 'a b\n1 2\n3 4\n')
+        rc, out, err = run_da(['filter', path, '-h1', '-p', 'f0 > 1', '--tag', '--pipe'])
+        self.assertEqual(out.splitlines(), ['a b tagged', '1 2 No', '3 4 Yes'])
+
+    def test_file_jobs_table(self):
+        for i in range(3):
+            self.write('{}.txt'.format(i), 'x{0} 1 2\ny{0} 5 6\n'.format(i))
+        pattern = os.path.join(self.tmp.name, '*.txt')
+        rc, serial, err = run_da(['filter', pattern, '-p', 'f1 > 3'])
+        rc, jobs, err = run_da(['filter', pattern, '--jobs', '2', '-p', 'f1 > 3'])
+        self.assertEqual(rc, 0, err)
+        self.assertIn('y2', jobs)
+        self.assertEqual(serial, jobs)
+
+    def test_bloom_rate(self):
+        path = self.write('k.txt', '1\n')
+        for rate in ('0', '1', '-0.5', '2', 'nan'):
+            rc, out, err = run_da(['filter', '-p', 'f0 in @{}'.format(path), '--bloom', rate], stdin='1\n')
+            self.assertNotEqual(rc, 0)
+            self.assertIn('invalid rate', err)
+        self.assertRaises(ValueError, BloomFilter, 10, error=0)
+
+    def test_regex_literal(self):
+        #(regex, text matching it, literal expected)
+        cases = [(r'/api/v[0-9]+/', '/api/v2/', '/api/v'), (r'ab\.c*d', 'ab.d', 'ab.'),
+                 (r'\x41BC', 'ABC', 'BC'), (r'\u00e9tat', '\u00e9tat', 'tat'),
+                 (r'\U000000e9tat', '\u00e9tat', 'tat'), (r'\N{LATIN SMALL LETTER E WITH ACUTE}tat', '\u00e9tat', 'tat'),
+                 (r'\101BC', 'ABC', 'BC'), (r'\0101', '\x081', '1'), (r'(a)xy\1', 'axya', 'xy'),
+                 (r'\d+abc', '12abc', 'abc'), (r'\bword\s', 'a word ', 'word'), (r'[\x5d]ab', ']ab', 'ab'),
+                 (r'a\-b', 'a-b', 'a-b'), (r'(?i)abc', 'ABC', ''), (r'ab|cd', 'cd', '')]
+        for regex, text, literal in cases:
+            self.assertTrue(re.search(regex, text), regex)
+            self.assertEqual(get_regex_literal(regex), literal, regex)
+        rc, out, err = run_da(['filter', '-p', "f0 ~ '\\x41BC'", '--pipe', '--noheading'], stdin='ABC 1\nXBC 2\n')
+        self.assertEqual(out, 'ABC 1\n')
+
+class TestAggregation(DaTestCase):
+    def test_jobs_sum_matches_serial(self):
+        #Sums which lose the small values when added in order
+        values = ['100000000000000000', '1', '-100000000000000000', '0.37']
+        path = self.write('s.txt', 'a v\n' + ''.join('k {}\n'.format(v) for i in range(20000) for v in values))
+        args = ['group', path, '-h1', '-r', '0', '-v', '1', '--aggfunc', 'sum', 'mean', 'stdev', '--pipe']
+        rc, serial, err = run_da(args)
+        self.assertEqual(serial.splitlines()[1].split()[1], '27400.0')
+        for jobs in ('2', '3', '7'):
+            self.assertEqual(run_da(args + ['--jobs', jobs])[1], serial)
+
+    def test_merged_states_are_exact(self):
+        rand = Random(1)
+        for name in ('sum', 'mean', 'stdev'):
+            xs = [rand.uniform(-1e6, 1e6) for i in range(500)]
+            whole, first, second = get_agg(name), get_agg(name), get_agg(name)
+            for n, x in enumerate(xs):
+                whole.add(x, x)
+                (first if n < 123 else second).add(x, x)
+            first.merge(second)
+            self.assertEqual(whole.result(), first.result())
+
+    def test_merge_states_with_other_input_options(self):
+        data = self.write('d.txt', 'a 1 5\nb 2 6\na 3 7\n')
+        states = []
+        for i, options in enumerate((['-v', '1'], ['-v', '1', '--decompress-thread'], ['-v', '2'])):
+            states.append(os.path.join(self.tmp.name, '{}.state'.format(i)))
+            run_da(['group', data, '-r', '0', '--aggfunc', 'sum', '--emit-state', states[-1]] + options)
+        rc, out, err = run_da(['merge', states[0], states[1], '--pipe', '--noheading'])
+        self.assertEqual((rc, out), (0, 'a 8.0\nb 4.0\n'), err)
+        #A different value column is a different aggregation
+        rc, out, err = run_da(['merge', states[0], states[2]])
+        self.assertNotEqual(rc, 0)
+        self.assertIn('different options', err)
+
+    def test_hyperloglog_error(self):
+        for n in (10, 1000, 10000, 100000):
+            whole, first, second = HyperLogLog(), HyperLogLog(), HyperLogLog()
+            for i in range(n):
+                whole.add('v{}'.format(i))
+                #Overlapping halves, and each value twice
+                if i < n*2//3:
+                    first.add('v{}'.format(i))
+                if i >= n//3:
+                    second.add('v{}'.format(i))
+                    second.add('v{}'.format(i))
+            #Within 3 standard errors, 1.04/sqrt(2**p)
+            self.assertLessEqual(abs(whole.count() - n), 3*1.04/sqrt(whole.m)*n, n)
+            first.merge(second)
+            self.assertEqual(first.count(), whole.count())
+
+    def test_amedian_exact_below_k(self):
+        for xs in ([1, 3], [5], [4, 1, 3, 2], list(range(199))):
+            agg = get_agg('amedian')
+            for x in xs:
+                agg.add(x, float(x))
+            self.assertEqual(agg.result(), median(xs))
+
+    def test_space_saving(self):
+        rand = Random(2)
+        counter = SpaceSaving(20)
+        counts = {}
+        for i in range(5000):
+            item = int(rand.paretovariate(1.2))
+            counter.add(item)
+            counts[item] = counts.get(item, 0) + 1
+        self.assertEqual(len(counter.heap), len(counter.counters))
+        for item, count, error in counter.top(20):
+            #Counts are overestimates by at most the error, which is bounded by total/capacity
+            self.assertTrue(count - error <= counts[item] <= count)
+            self.assertTrue(error <= counter.total/counter.capacity)
+
+class TestInput(DaTestCase):
+    def test_text_starting_with_bzh(self):
+        rc, out, err = run_da(['table', '--pipe', '--noheading'], stdin='BZhang 1\n')
+        self.assertEqual((rc, out), (0, 'BZhang 1\n'))
+
+    def test_bz2_file(self):
+        path = os.path.join(self.tmp.name, 'b.txt.bz2')
+        with bz2.open(path, 'wt') as fd:
+            fd.write('a 1\nb 2\n')
+        rc, out, err = run_da(['table', path, '--pipe', '--noheading'])
+        self.assertEqual(out, 'a 1\nb 2\n')
+
+    def test_pipe_files(self):
+        #Named pipe
+        fifo = os.path.join(self.tmp.name, 'fifo')
+        os.mkfifo(fifo)
+        def write_fifo():
+            with open(fifo, 'w') as fd:
+                fd.write('a 1\nb 2\n')
+        #The writer waits till da opens the pipe, daemon so that it does not block the checks if da does not
+        Thread(target=write_fifo, daemon=True).start()
+        p = subprocess.run([sys.executable, os.path.join(here, 'da_tool.py'), 'table', fifo, '--pipe', '--noheading'],
+                           capture_output=True, text=True, timeout=60)
+        out, err = p.stdout, p.stderr
+        self.assertEqual((p.returncode, out), (0, 'a 1\nb 2\n'), err)
+        #Process substitution (/dev/fd/N), also compressed as it cannot be opened again
+        for data in (b'a 1\nb 2\n', bz2.compress(b'a 1\nb 2\n')):
+            r, w = os.pipe()
+            os.write(w, data)
+            os.close(w)
+            try:
+                p = subprocess.run([sys.executable, os.path.join(here, 'da_tool.py'), 'table', '/dev/fd/{}'.format(r),
+                                    '--pipe', '--noheading'], capture_output=True, text=True, pass_fds=(r,))
+            finally:
+                os.close(r)
+            self.assertEqual((p.returncode, p.stdout), (0, 'a 1\nb 2\n'), p.stderr)
+        for path in (os.path.join(self.tmp.name, 'missing.txt'), self.tmp.name):
+            rc, out, err = run_da(['table', path])
+            self.assertNotEqual(rc, 0)
+            self.assertIn('Cannot read the input file: {}'.format(path), err)
+
+    def test_pipe_streams_before_eof(self):
+        for extra in ([], ['--decompress-thread']):
+            p = subprocess.Popen([sys.executable, os.path.join(here, 'da_tool.py'), 'filter', '-p', "f0 == 'a'",
+                                  '--pipe', '--noheading', '--line-buffered'] + extra,
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            try:
+                #stdin stays open, the matching row has to come out before the end of the input
+                p.stdin.write(b'a 1\nb 2\n')
+                p.stdin.flush()
+                ready, _, _ = select.select([p.stdout], [], [], 10)
+                self.assertTrue(ready, "no output before the end of the input")
+                self.assertEqual(p.stdout.readline(), b'a 1\n')
+            finally:
+                p.stdin.close()
+                p.wait()
+                p.stdout.close()
+
+    def test_merge_bad_state_files(self):
+        state = os.path.join(self.tmp.name, 'g.state')
+        data = self.write('d.txt', 'a 1\nb 2\n')
+        run_da(['group', data, '-r', '0', '-v', '1', '--aggfunc', 'sum', '--emit-state', state])
+        with open(state, 'rb') as fd:
+            content = fd.read()
+        truncated = os.path.join(self.tmp.name, 't.state')
+        with open(truncated, 'wb') as fd:
+            fd.write(content[:len(content)//2])
+        for path in (os.path.join(self.tmp.name, 'missing.state'), truncated, data):
+            rc, out, err = run_da(['merge', path])
+            self.assertNotEqual(rc, 0)
+            self.assertNotIn('Traceback', err)
+            self.assertIn(path, err)
+
+class TestOutput(DaTestCase):
+    def test_progressive_table(self):
+        #The widths come from the first 2 rows, a wider value prints the heading again
+        rc, out, err = run_da(['table', '--progressive', '2'], stdin='a 1\nb 2\nlonger 3\nc 4\n')
+        self.assertEqual(out.splitlines(), ['col0 | col1 | ', '-'*13, 'a    |    1 | ', 'b    |    2 | ',
+                                            '-'*15, 'col0   | col1 | ', '-'*15, 'longer |    3 | ', 'c      |    4 | '])
+        #The rows are printed before the end of the input
+        #Unbuffered, so that select sees the lines which are not read yet
+        p = subprocess.Popen([sys.executable, os.path.join(here, 'da_tool.py'), 'table', '--progressive', '2', '--line-buffered'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        try:
+            p.stdin.write(b'a 1\nb 2\nc 3\n')
+            p.stdin.flush()
+            lines = []
+            while len(lines) < 5:
+                ready, _, _ = select.select([p.stdout], [], [], 10)
+                self.assertTrue(ready, "no output before the end of the input")
+                lines.append(p.stdout.readline())
+            self.assertEqual(lines[2:], [b'a    |    1 | \n', b'b    |    2 | \n', b'c    |    3 | \n'])
+        finally:
+            p.stdin.close()
+            p.wait()
+            p.stdout.close()
+
+class TestSort(DaTestCase):
+    def test_external_sort_many_runs(self):
+        rand = Random(2)
+        #Repeated keys, the second field checks that ties keep the input order
+        path = self.write('s.txt', ''.join('{} {}\n'.format(rand.randint(0, 50), i) for i in range(3000)))
+        #A few rows in each run, so that the runs are merged in passes with few open files
+        limit_files = lambda: resource.setrlimit(resource.RLIMIT_NOFILE, (32, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+        for options in ([], ['--numeric', '--desc']):
+            rc, expected, err = run_da(['sort', path, '--pipe'] + options)
+            p = subprocess.run([sys.executable, os.path.join(here, 'da_tool.py'), 'sort', path, '--pipe',
+                                '--memory-limit', '1K'] + options, capture_output=True, text=True, preexec_fn=limit_files)
+            self.assertEqual(p.returncode, 0, p.stderr)
+            self.assertEqual(p.stdout, expected)
+
+    def test_rank_methods_and_keys(self):
+        #Ties, and cells which are not numbers (ranked together below the numbers)
+        path = self.write('r.txt', 'a 3\nb 1\nc x\nd 3\ne y\nf 2\n')
+        expected = {'competition': ['4 0', '2 3', '0 4', '4 0', '0 4', '3 2'],
+                    'dense': ['3 0', '1 2', '0 3', '3 0', '0 3', '2 1'],
+                    'ordinal': ['4 0', '2 3', '0 4', '5 1', '1 5', '3 2'],
+                    'percent': ['0.8 0.0', '0.4 0.6', '0.0 0.8', '0.8 0.0', '0.0 0.8', '0.6 0.4']}
+        for method, ranks in expected.items():
+            rc, out, err = run_da(['sort', path, '-k', '0', '--numeric', '--rank-key', '1', '1:desc',
+                                   '--rank-method', method, '--pipe', '--noheading'])
+            self.assertEqual([line.split(' ', 2)[2] for line in out.splitlines()], ranks, method)
+        #Ranking the sort key uses the sorted order, the ranks are the same
+        rc, out, err = run_da(['sort', path, '-k', '1', '--numeric', '--rank-key', '1', '--pipe', '--noheading'])
+        self.assertEqual(sorted(out.splitlines()), ['a 3 4', 'b 1 2', 'c x 0', 'd 3 4', 'e y 0', 'f 2 3'])
+        for key in ('x', '1:up', '1:', '-1'):
+            rc, out, err = run_da(['sort', path, '--rank-key', key])
+            self.assertNotEqual(rc, 0)
+            self.assertIn("invalid rank key: '{}'".format(key), err)
+            self.assertNotIn('Traceback', err)
+
+class TestCache(DaTestCase):
+    def test_hist_matches_direct(self):
+        #Blocks of 64 rows (a multiple of 8, like cache_block_rows), with numbers only, strings only
+        # and both, so that some are skipped with --min/--max
+        values = [str(i) for i in range(1024)] + ['foo']*128 + ['bar', '7']*64
+        text = self.write('h.txt', ''.join(v + '\n' for v in values))
+        cache = os.path.join(self.tmp.name, 'h.dac')
+        writer = CacheWriter(cache, block_rows=64)
+        for v in values:
+            writer.add_row([v])
+        writer.close()
+        for limits in ([], ['--min', '500'], ['--max', '5'], ['--min', '2000'], ['--max', '-1'], ['--min', '100', '--max', '150']):
+            rc, direct, err = run_da(['hist', text] + limits)
+            rc, cached, err = run_da(['hist', '--from-cache', cache] + limits)
+            self.assertEqual(rc, 0, err)
+            self.assertEqual(direct, cached, limits)
+
+    def test_filter_matches_direct(self):
+        rand = Random(3)
+        rows = [[str(i), rand.choice(['foo', 'bar', '7']), str(rand.randint(-5, 5))] for i in range(1024)]
+        #Blocks without numbers in field 0 (short rows are padded in a cache, so all the rows have 3 fields)
+        rows += [['x', 'foo', 'z']]*64 + [['y', 'bar', '1']]*64
+        text = self.write('f.txt', ''.join(' '.join(row) + '\n' for row in rows))
+        cache = os.path.join(self.tmp.name, 'f.dac')
+        writer = CacheWriter(cache, block_rows=64)
+        for row in rows:
+            writer.add_row(row)
+        writer.close()
+        for pattern in ('f0 > 500', 'f0 == 700', 'f0 > 2000', 'f0 < 10 OR f1 == "foo"', 'NOT f0 > 100',
+                        'f0 >= 1000 AND f2 < 0', 'f1 ~ "^f" AND f0 <= 3', 'f2 != 0 AND (f0 < 64 OR f0 > 960)'):
+            rc, direct, err = run_da(['filter', text, '-p', pattern, '--pipe'])
+            rc, cached, err = run_da(['filter', '--from-cache', cache, '-p', pattern, '--pipe'])
+            self.assertEqual(rc, 0, err)
+            self.assertEqual(direct, cached, pattern)
+        #Zone maps (min, max, nulls) of the fields of a block
+        zones = {0: (0, 63, 0), 1: (7, 7, 50), 2: (-5, 5, 0)}.get
+        self.assertFalse(compile_zone_filter('f0 > 100')(zones))
+        self.assertFalse(compile_zone_filter('f0 > 100 OR f2 < -5')(zones))
+        self.assertTrue(compile_zone_filter('f0 > 10 AND f2 == 5')(zones))
+        #Strings and NOT cannot be checked with the zone maps
+        self.assertTrue(compile_zone_filter('f1 == "foo"')(zones))
+        self.assertTrue(compile_zone_filter('NOT f0 < 100')(zones))
+
+class TestFlatFile(DaTestCase):
+    def test_da_is_generated_from_the_modules(self):
+        #get_daflat.py writes da into the current directory
+        subprocess.run([sys.executable, os.path.join(here, 'get_daflat.py')], cwd=self.tmp.name,
+                       stdin=subprocess.DEVNULL, capture_output=True, check=True)
+        with open(os.path.join(self.tmp.name, 'da')) as generated, open(os.path.join(here, 'da')) as committed:
+            self.assertTrue(generated.read() == committed.read(), "da is out of date, run get_daflat.py")
+
+if __name__ == '__main__':
+    unittest.main()